@@ -1,16 +1,17 @@
 import logging
-import json5
 import threading
+import time
 import os
 import sys
+import signal
 import getopt
 
-from .telegram import TelegramClient
-from .irc import IRCClient
-from .bridge import Bridge
-from .web_backend import WebBackend
+from . import instrument
+
+# telebot, irc etc. are imported by the bootstrap threads, see main()
 
 opts = {}
+shutting_down = False
 
 def start_new_thread(func, join=False, args=(), kwargs=None):
 	t = threading.Thread(target=func, args=args, kwargs=kwargs)
@@ -24,26 +25,103 @@ def readopt(name):
 			return e[1]
 	return None
 
-def parse_config(path):
-	with open(path, "rb") as f:
-		s = f.read()
+def parse_config(path, fatal=True):
+	import json5
 	try:
+		with open(path, "rb") as f:
+			s = f.read()
 		return json5.loads(s)
-	except ValueError as e:
+	except (OSError, ValueError) as e:
 		logging.error("Failed to parse configuration file:\n%s", e)
-		exit(1)
+		if fatal:
+			exit(1)
+		return None
+
+def reload_config(path, b):
+	logging.info("Reloading configuration")
+	config = parse_config(path, fatal=False)
+	if config is None:
+		return
+	try:
+		b.reload(config["bridge"])
+	except (KeyError, TypeError):
+		logging.exception("Reloading configuration failed")
+
+def shutdown(b, capture=None):
+	global shutting_down
+	if shutting_down:
+		logging.warning("Exiting immediately")
+		os._exit(1)
+	shutting_down = True
+	def run():
+		ok = b.shutdown()
+		if capture is not None:
+			capture.close()
+		logging.info("Shutdown %s", "complete" if ok else "incomplete, some messages were lost")
+		logging.shutdown()
+		os._exit(0 if ok else 1)
+	start_new_thread(run)
+
+class Bootstrap():
+	# Imports and creates a client in the background, then runs its
+	# blocking network setup (DNS, TCP/TLS, first API call) while the main
+	# thread sets up the bridge.
+	def __init__(self, name, create, config):
+		self.timer = instrument.StageTimer(name)
+		self.client = None
+		self.error = None
+		self.ok = False
+		self.created = threading.Event()
+		self.thread = threading.Thread(target=self._run, args=(create, config), name="bootstrap-" + name)
+		self.thread.start()
+
+	def _run(self, create, config):
+		try:
+			self.client = create(config)
+		except BaseException as e: # includes exit() on invalid config
+			self.error = e
+			return
+		finally:
+			self.timer.mark("create")
+			self.created.set()
+		self.ok = self.client.connect() is not False
+		self.timer.mark("connect")
+
+	def get(self):
+		self.created.wait()
+		if self.error is not None:
+			raise self.error
+		return self.client
+
+	def wait(self):
+		self.thread.join()
+		return self.ok
+
+def create_telegram(config):
+	from .telegram import TelegramClient
+	return TelegramClient(config)
+
+def create_irc(config):
+	from .irc import IRCClient
+	return IRCClient(config)
+
+def usr1(b):
+	b.log_stats()
+	instrument.profile(b.conf.profile_seconds)
 
 def usage():
-	print("Usage: %s [-q] [-c file] [-D]" % sys.argv[0])
+	print("Usage: %s [-q] [-c file] [-D] [-w file [-r]]" % sys.argv[0])
 	print("Options:")
 	print("  -q    Be quieter, raise log level to WARNING")
 	print("  -c    Set location of config file (default: ./config.json)")
 	print("  -D    Fork into background")
+	print("  -w    Capture incoming Telegram updates and IRC lines to file (see pytgbridge.replay)")
+	print("  -r    Redact tokens and phone numbers in the capture")
 
 def main():
 	global opts
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "hqc:D", ["help"])
+		opts, args = getopt.getopt(sys.argv[1:], "hqc:Dw:r", ["help"])
 	except getopt.GetoptError as e:
 		print(str(e))
 		exit(1)
@@ -52,34 +130,70 @@ def main():
 		usage()
 		exit(0)
 	loglevel = logging.INFO if readopt("-q") is None else logging.WARNING
-	configpath = readopt("-c") or "./config.json"
+	# the builtin web backend changes the working directory
+	configpath = os.path.abspath(readopt("-c") or "./config.json")
+	capturepath = readopt("-w")
+	if capturepath is not None:
+		capturepath = os.path.abspath(capturepath)
 	# Fork into background
 	if readopt("-D") is not None and os.fork():
 		sys.exit()
 
 	logging.basicConfig(format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=loglevel)
+	boot = instrument.startup = instrument.StageTimer("startup")
 
 	config = parse_config(configpath)
+	boot.mark("config")
 
 	logging.info("Starting up...")
 	try:
-		tg = TelegramClient(config["telegram"])
-		irc = IRCClient(config["irc"])
+		tgb = Bootstrap("telegram", create_telegram, config["telegram"])
+		ircb = Bootstrap("irc", create_irc, config["irc"])
+		from .bridge import Bridge
+		from .web_backend import WebBackend
+		boot.mark("imports")
 		wb = WebBackend(config["web_backend"])
+		boot.mark("web_backend")
+		tg, irc = tgb.get(), ircb.get()
+		boot.mark("clients")
 		b = Bridge(tg, irc, wb, config["bridge"])
-	except (KeyError, TypeError):
+		boot.mark("bridge")
+	except (KeyError, TypeError, ValueError):
 		logging.exception("")
 		logging.error("Your pytgbridge configuration is incomplete or invalid.\n"+
 			"The stacktrace usually contains a hint at whats wrong.")
 		os._exit(1)
+	except SystemExit:
+		os._exit(1)
 
-	start_new_thread(tg.run)
+	capture = None
+	if capturepath is not None:
+		from .capture import CaptureWriter
+		try:
+			capture = CaptureWriter(capturepath, redact=readopt("-r") is not None)
+		except OSError as e:
+			logging.error("Failed to open capture file: %s", e)
+			os._exit(1)
+		tg.set_capture(capture)
+		irc.set_capture(capture)
+		logging.info("Capturing incoming traffic to %s", capturepath)
 
-	try:
-		start_new_thread(irc.run, join=True)
-	except KeyboardInterrupt:
-		logging.info("Interrupted, exiting")
+	# only the bridge section can be changed without a restart
+	signal.signal(signal.SIGHUP, lambda signum, frame: start_new_thread(reload_config, args=(configpath, b)))
+	signal.signal(signal.SIGUSR1, lambda signum, frame: start_new_thread(usr1, args=(b, )))
+	# a second signal exits right away
+	signal.signal(signal.SIGTERM, lambda signum, frame: shutdown(b, capture))
+	signal.signal(signal.SIGINT, lambda signum, frame: shutdown(b, capture))
+
+	# polling can start while IRC is still connecting
+	tgb.wait()
+	start_new_thread(tg.run)
+	if not ircb.wait():
 		os._exit(1)
+	boot.mark("network")
+	logging.info("Startup took %.0fms (%s; in parallel: %s)", boot.elapsed() * 1000, boot.describe(),
+		"; ".join("%s %s" % (x.timer.name, x.timer.describe()) for x in (tgb, ircb)))
+	start_new_thread(irc.run, join=True)
 
 if __name__ == "__main__":
 	main()
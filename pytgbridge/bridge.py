@@ -1,8 +1,17 @@
 import re
+import html
+import time
 import logging
-from collections import namedtuple
+import threading
+from collections import namedtuple, OrderedDict
 
 from .web_backend import WebpConverter
+from .events import User, to_html
+from .membership import MembershipCoalescer
+from .dispatch import Dispatcher
+from .outbound import OutboundQueue, PRIO_CHAT, PRIO_MEDIA, PRIO_EVENT, prio_names
+from .templates import compile_templates
+from . import instrument
 
 def dump(obj, name=None, r=False): ##DEBUG##
 	name = "" if name is None else (name + ".")
@@ -61,16 +70,17 @@ class NickColorizer():
 		color = self.colors[color]
 		return "\x03%02d%s\x0f" % (color, s)
 
+StyleCombo = namedtuple("StyleCombo", ["open", "close"])
+
 class IRCFormattingConverter(): # IRC -> HTML
 	def __init__(self, enabled):
 		self.enabled = enabled
-		tmp = namedtuple("StyleCombo", ["open", "close"])
 		if self.enabled:
-			self.bold = tmp(open="<b>", close="</b>")
-			self.italics = tmp(open="<i>", close="</i>")
-			self.underline = tmp(open="<u>", close="</u>")
+			self.bold = StyleCombo(open="<b>", close="</b>")
+			self.italics = StyleCombo(open="<i>", close="</i>")
+			self.underline = StyleCombo(open="<u>", close="</u>")
 		else:
-			self.bold = self.italics = self.underline = tmp(open="", close="")
+			self.bold = self.italics = self.underline = StyleCombo(open="", close="")
 	def convert(self, text):
 		bold = italics = underline = False
 		skip_digits = 0
@@ -117,7 +127,7 @@ class TelegramFormattingConverter(): # Telegram -> IRC
 	def __init__(self, enabled, userfmt):
 		self.enabled = enabled
 		self.userfmt = userfmt
-	def convert(self, text, entities):
+	def convert(self, text, entities, mentionfmt=None):
 		_enc = "utf-16-le" # need to specify endianness to avoid a BOM
 		_filt = lambda text: text.replace("\n", " … ")
 		if not self.enabled or entities is None:
@@ -145,12 +155,8 @@ class TelegramFormattingConverter(): # Telegram -> IRC
 			rlen = e.length << 1
 			etext = _filt(text[tpos:tpos+rlen].decode("utf16"))
 			if e.type == "mention":
-				u = namedtuple("FakeUser", ["username", "first_name", "last_name"])(
-					username=etext[1:],
-					first_name=None,
-					last_name=None,
-				)
-				ret += "@" + self.userfmt(u)
+				nick = None if mentionfmt is None else mentionfmt(etext[1:])
+				ret += nick or ("@" + self.userfmt(User(None, username=etext[1:])))
 			elif e.type in ("code", "pre"):
 				c = 15
 				ret += "\x03%02d" % c + etext + "\x0f"
@@ -170,6 +176,7 @@ class TelegramFormattingConverter(): # Telegram -> IRC
 		return ret
 
 LinkTuple = namedtuple("LinkTuple", ["telegram", "irc"])
+Routing = namedtuple("Routing", ["links", "by_tg", "by_irc"])
 config_names = [
 	"telegram_bold_nicks",
 	"telegram_show_joins",
@@ -183,10 +190,93 @@ config_names = [
 	"forward_audio_description",
 	"forward_text_formatting_irc",
 	"forward_text_formatting_telegram",
+	"poll_update_interval",
+	"paste_max_lines",
+	"paste_max_bytes",
+	"telegram_join_window",
+	"telegram_join_burst",
+	"queue_max_per_link",
+	"dispatch_workers",
+	"dispatch_queue_size",
+	"media_preview_size",
+	"slow_handler_ms",
+	"profile_seconds",
+	"shutdown_timeout",
 ]
+Converters = namedtuple("Converters", ["irc", "tg"])
+Queues = namedtuple("Queues", ["irc", "tg"])
 config_defaults = {
 	"irc_nick_colors": None, # uses default colors
+	"poll_update_interval": 300,
+	"paste_max_lines": 4,
+	"paste_max_bytes": 1000,
+	"telegram_join_window": 10,
+	"telegram_join_burst": 3,
+	"queue_max_per_link": 100,
+	"dispatch_workers": 4,
+	"dispatch_queue_size": 1000,
+	"media_preview_size": 0,
+	"slow_handler_ms": 1000,
+	"profile_seconds": 30,
+	"shutdown_timeout": 10,
 }
+Conf = namedtuple("Conf", config_names)
+
+POLL_STATE_MAX = 500 # number of polls we remember vote counts for
+
+PASTE_PREVIEW_LEN = 80
+PASTE_TEMPLATE = """<!DOCTYPE html><meta charset="utf-8"><title>%s</title>
+<pre style="white-space:pre-wrap">%s</pre>
+"""
+
+PREVIEW_CACHE_MAX = 1000 # number of preview URLs remembered for reuse
+PREVIEW_TYPES = ("photo", "video", "animation", "video_note", "document")
+
+TG_USERS_MAX = 10000 # number of Telegram users remembered for mentions from IRC
+
+# "@name" anywhere or "name:" / "name," at the start of a message
+irc_mention_re = re.compile(r"(?:(?<![\w@&;])@(\w+)|^(\w+)(?=[:,]))")
+
+class TelegramUserIndex():
+	# Maps (chat, lowercased username or first name) to user id, for the
+	# users we have seen recently. Bounded so big groups don't grow it forever.
+	# First names aren't unique: one shared by several users maps to None,
+	# and a username always takes precedence over a first name.
+	def __init__(self, size):
+		self.size = size
+		self.users = OrderedDict() # (chat id, name) -> (user id or None, is username)
+		self.lock = threading.Lock()
+	def add(self, chat_id, user):
+		if user.username is not None:
+			key, entry = (chat_id, user.username.lower()), (user.id, True)
+		elif user.first_name and " " not in user.first_name:
+			key, entry = (chat_id, user.first_name.lower()), (user.id, False)
+		else:
+			return
+		with self.lock:
+			old = self.users.get(key)
+			if not entry[1] and old is not None and old[0] != user.id:
+				entry = old if old[1] else (None, False)
+			self.users[key] = entry
+			self.users.move_to_end(key)
+			while len(self.users) > self.size:
+				self.users.popitem(last=False)
+	def find(self, chat_id, name):
+		entry = self.users.get((chat_id, name.lower()))
+		return None if entry is None else entry[0]
+
+class PollState():
+	def __init__(self, counts, closed):
+		self.counts = counts # as last sent to IRC
+		self.closed = closed
+		self.last_sent = time.monotonic()
+		self.pending = None # throttled poll, sent once the interval is over
+		self.timer = None
+	def cancel(self):
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		self.pending = None
 
 class Bridge():
 	def __init__(self, tg, irc, wb, config):
@@ -194,26 +284,33 @@ class Bridge():
 		self.irc = irc
 		self.web = wb
 		#
-		self.links = set(LinkTuple(**e) for e in config["links"])
-		logging.info("%d link(s) configured", len(self.links))
-		options = config_defaults.copy()
-		options.update(config["options"])
-		self.conf = namedtuple("Conf", config_names)(**options)
-		if self.conf.convert_webp_stickers:
-			WebpConverter.check()
-		self.tg_ignore_users = set(config.get("telegram_ignore_users", []))
-		#
-		self.nc = NickColorizer(self.conf.irc_nick_colors)
-		self.tf = namedtuple("T", ["irc", "tg"])(
-			irc=IRCFormattingConverter(self.conf.forward_text_formatting_irc),
-			tg=TelegramFormattingConverter(self.conf.forward_text_formatting_telegram, self._tg_format_user),
+		self.conf = self.nc = self.tf = self.tpl = None
+		self._load_config(config)
+		logging.info("%d link(s) configured", len(self.routing.links))
+		self.polls = OrderedDict() # (chat id, poll id) -> PollState
+		self.polls_lock = threading.Lock()
+		self.tg_users = TelegramUserIndex(TG_USERS_MAX)
+		self.previews = OrderedDict() # file_unique_id -> URL
+		self.previews_lock = threading.Lock()
+		self.out = Queues(
+			irc=OutboundQueue("IRC", self.irc.privmsg, self.conf.queue_max_per_link,
+				format_shed=lambda shed: self._format_shed("tg", shed)),
+			# sends to different chats don't wait for each other, IRC has only one connection anyway
+			tg=OutboundQueue("Telegram", self._tg_send_html, self.conf.queue_max_per_link,
+				senders=max(self.conf.dispatch_workers, 1), format_shed=lambda shed: self._format_shed("irc", shed)),
 		)
+		# worker count (also used for the Telegram senders) can't be changed on reload
+		self.dispatch = Dispatcher(self.conf.dispatch_workers, self.conf.dispatch_queue_size)
+		instrument.context = lambda: "dispatch queues " + self.dispatch.describe()
+		self.joins = MembershipCoalescer(self.conf.telegram_join_window, self.conf.telegram_join_burst,
+			self._tg_send_membership, self._tg_send_membership_summary)
 
 		self.irc.event_handler("connected", self.irc_connected)
 		self._irc_event_handler("message", self.irc_message)
 		self._irc_event_handler("action", self.irc_action)
 		self._irc_event_handler("join", self.irc_join)
 		self._irc_event_handler("part", self.irc_part)
+		self._irc_event_handler("quit", self.irc_quit)
 		self._irc_event_handler("kick", self.irc_kick)
 		self.tg.event_handler("cmd_help", self.tg_help)
 		self._tg_event_handler("cmd_me", self.tg_me)
@@ -231,6 +328,99 @@ class Bridge():
 		self._tg_event_handler("cphoto_deleted", self.tg_cphoto_deleted)
 		self._tg_event_handler("cpinned_changed", self.tg_cpinned_changed)
 
+	def _load_config(self, config):
+		# Everything is parsed and validated first, then swapped in at once
+		links = frozenset(LinkTuple(**e) for e in config["links"])
+		routing = Routing(links, {l.telegram: l for l in links}, {l.irc: l for l in links})
+		options = config_defaults.copy()
+		options.update(config["options"])
+		conf = Conf(**options)
+		if conf.queue_max_per_link < 1:
+			raise ValueError("queue_max_per_link must be at least 1")
+		ignore = frozenset(config.get("telegram_ignore_users", []))
+		tpl = compile_templates(config.get("templates"), conf.telegram_bold_nicks)
+		old = self.conf
+		if conf.convert_webp_stickers and (old is None or not old.convert_webp_stickers):
+			if not WebpConverter.check(fatal=old is None):
+				raise ValueError("WebP tools not available")
+		# only recreate converters whose settings changed
+		if old is None or old.irc_nick_colors != conf.irc_nick_colors:
+			nc = NickColorizer(conf.irc_nick_colors)
+		else:
+			nc = self.nc
+		if old is None or old.forward_text_formatting_irc != conf.forward_text_formatting_irc:
+			tf_irc = IRCFormattingConverter(conf.forward_text_formatting_irc)
+		else:
+			tf_irc = self.tf.irc
+		if old is None or old.forward_text_formatting_telegram != conf.forward_text_formatting_telegram:
+			tf_tg = TelegramFormattingConverter(conf.forward_text_formatting_telegram, self._tg_format_user)
+		else:
+			tf_tg = self.tf.tg
+		#
+		self.nc = nc
+		self.tf = Converters(irc=tf_irc, tg=tf_tg)
+		self.tg_ignore_users = ignore
+		self.tpl = tpl
+		self.conf = conf
+		self.routing = routing
+		instrument.slow_threshold = conf.slow_handler_ms / 1000 if conf.slow_handler_ms > 0 else None
+
+	def reload(self, config):
+		old = self.routing
+		try:
+			self._load_config(config)
+		except (KeyError, TypeError, ValueError) as e:
+			logging.error("Reloading configuration failed, keeping the old one: %r", e)
+			return False
+		self.out.irc.max_per_target = self.out.tg.max_per_target = self.conf.queue_max_per_link
+		self.joins.window = self.conf.telegram_join_window
+		self.joins.burst = self.conf.telegram_join_burst
+		# join/part only the channels that changed
+		old_channels = set(l.irc for l in old.links)
+		new_channels = set(l.irc for l in self.routing.links)
+		for channel in new_channels - old_channels:
+			self.irc.join(channel)
+		for channel in old_channels - new_channels:
+			self.irc.part(channel)
+		logging.info("Configuration reloaded, %d link(s) configured (%d channel(s) joined, %d parted)",
+			len(self.routing.links), len(new_channels - old_channels), len(old_channels - new_channels))
+		return True
+
+	def log_stats(self):
+		logging.info("Dispatch queues (depth/highest per worker): %s", self.dispatch.describe())
+		for q in self.out:
+			logging.info("%s output: %d message(s) sent, %d pending, dropped: %s",
+				q.name, q.sent_total, q.pending(), q.describe_shed())
+		self.web.log_stats()
+
+	def shutdown(self):
+		# Stops taking new events and waits (up to shutdown_timeout) until
+		# everything received so far has been handled and sent.
+		# Returns False if something had to be given up.
+		deadline = time.monotonic() + self.conf.shutdown_timeout
+		remaining = lambda: max(deadline - time.monotonic(), 0)
+		logging.info("Shutting down, waiting up to %ds for pending messages", self.conf.shutdown_timeout)
+		self.irc.stop()
+		ok = self.tg.stop(remaining())
+		if not ok:
+			logging.warning("Telegram polling did not stop in time")
+		if not self.dispatch.join(remaining()):
+			logging.warning("Not all events could be handled in time")
+			ok = False
+		# summaries and poll updates waiting for a timer are sent right away
+		if not self.joins.flush_all():
+			ok = False
+		if not self._tg_poll_flush_all():
+			ok = False
+		if not self.web.shutdown(remaining()):
+			ok = False
+		for q in self.out:
+			if not q.drain(remaining()):
+				logging.warning("%d message(s) to %s could not be sent in time", q.pending(), q.name)
+				ok = False
+		self.irc.quit("pytgbridge shutting down")
+		return ok
+
 	def _irc_event_handler(self, event, func):
 		# So we don't have to repeat this code in every handler
 		def wrap(event, *args):
@@ -240,34 +430,31 @@ class Bridge():
 			if l is None:
 				logging.warning("IRC channel %s is not linked to anywhere", event.channel)
 				return
-			func(l, event, *args)
+			event.link = l
+			self.dispatch.submit(l, func, l, event, *args)
 		self.irc.event_handler(event, wrap)
 
 	def _tg_event_handler(self, event, func):
 		# So we don't have to repeat this code in every handler
 		def wrap(event, *args):
-			if event.chat.type in ("private", "channel"):
+			if event.chat_type in ("private", "channel"):
 				return
 			l = self._find_link(tg=event)
 			if l is None:
-				logging.warning("Telegram chat %d is not linked to anywhere", event.chat.id)
+				logging.warning("Telegram chat %d is not linked to anywhere", event.chat_id)
 				return
-			if event.from_user.id in self.tg_ignore_users:
+			if event.sender.id in self.tg_ignore_users:
 				return
-			func(l, event, *args)
+			self.tg_users.add(event.chat_id, event.sender)
+			event.link = l
+			self.dispatch.submit(l, func, l, event, *args)
 		self.tg.event_handler(event, wrap)
 
 	def _find_link(self, tg=None, irc=None):
 		if tg is not None:
-			for l in self.links:
-				if l.telegram == tg.chat.id:
-					return l
-			return None
+			return self.routing.by_tg.get(tg.chat_id)
 		elif irc is not None:
-			for l in self.links:
-				if l.irc == irc.channel:
-					return l
-			return None
+			return self.routing.by_irc.get(irc.channel)
 		raise NotImplementedError()
 
 	def _tg_format_user(self, user):
@@ -281,83 +468,152 @@ class Bridge():
 		return self.nc.colorize( v1 + " " + (v2 or "") )
 
 	def _tg_format_msg_prefix(self, event, action=False):
-		fmt = "* %s" if action else "<%s>"
-		r = fmt % self._tg_format_user(event.from_user)
-		if event.reply_to_message is not None and not action:
-			if event.reply_to_message.from_user.id == self.tg.get_own_user().id:
-				m = re.match(r"(?:<([^>]+)>|\* ([^ ]+)) ", event.reply_to_message.text or "")
+		fmt = self.tpl["tg_prefix_action" if action else "tg_prefix"]
+		r = fmt(user=self._tg_format_user(event.sender))
+		if event.reply_to is not None and not action:
+			if event.reply_to.sender.id == self.tg.get_own_user().id:
+				m = re.match(r"(?:<([^>]+)>|\* ([^ ]+)) ", event.reply_to.text or "")
 				if m:
 					# i don't understand why this happens
-					r += " %s," % (m.group(1) or m.group(2))
+					r += self.tpl["tg_prefix_reply_irc"](nick=m.group(1) or m.group(2))
 				else:
-					logging.warning("Failed to parse our own message: %r", event.reply_to_message.text)
+					logging.warning("Failed to parse our own message: %r", event.reply_to.text)
 			else:
-				r += " @%s," % self._tg_format_user(event.reply_to_message.from_user)
-		if event.forward_from is not None:
-			r += " Fwd from %s:" % self._tg_format_user(event.forward_from)
-		elif event.forward_from_chat is not None:
-			r += " Fwd from %s:" % event.forward_from_chat.title
-		elif event.forward_sender_name is not None:
-			r += " Fwd from %s:" % event.forward_sender_name
+				r += self.tpl["tg_prefix_reply"](user=self._tg_format_user(event.reply_to.sender))
+		if isinstance(event.forward_from, User):
+			r += self.tpl["tg_prefix_forward"](name=self._tg_format_user(event.forward_from))
+		elif event.forward_from is not None: # name of chat or hidden user
+			r += self.tpl["tg_prefix_forward"](name=event.forward_from)
 		return r
 
-	def _tg_format_msg(self, event):
+	def _tg_format_msg(self, l, event):
 		# TODO: move code for media messages here (for media in pinned messages)
-		pre = self._tg_format_msg_prefix(event) + " "
-		if event.content_type != "text":
-			return pre + "(Media message)"
-		return pre + self.tf.tg.convert(event.text, event.entities)
+		prefix = self._tg_format_msg_prefix(event)
+		if event.kind != "text":
+			return self.tpl["tg_media_message"](prefix=prefix)
+		return self.tpl["tg_message"](prefix=prefix, text=self._tg_convert(l, event))
+
+	def _tg_convert(self, l, event):
+		# @mentions of IRC users are turned into their actual nick
+		def mentionfmt(name):
+			if self.tg_users.find(l.telegram, name) is not None:
+				return None
+			return self.irc.find_nick(l.irc, name)
+		return self.tf.tg.convert(event.text, event.entities, mentionfmt)
+
+	def _irc_mentions(self, l, text):
+		# turn mentions of Telegram users into real mentions
+		def repl(m):
+			name = m.group(1) or m.group(2)
+			uid = self.tg_users.find(l.telegram, name)
+			if uid is None:
+				return m.group(0)
+			return "%s<a href=\"tg://user?id=%d\">%s</a>" % ("@" if m.group(1) else "", uid, name)
+		return irc_mention_re.sub(repl, text)
+
+	def _irc_send(self, l, prio, text):
+		instrument.mark("format")
+		self.out.irc.put(l.irc, prio, text)
+
+	def _tg_send(self, l, prio, text):
+		instrument.mark("format")
+		self.out.tg.put(l.telegram, prio, text)
+
+	def _format_shed(self, source, shed):
+		# source is where the dropped messages came from
+		items = ", ".join(self.tpl[source + "_dropped_item"](count=n, kind=prio_names[p])
+			for p, n in sorted(shed.items()))
+		return self.tpl[source + "_dropped"](dropped=items)
+
+	def _tg_send_html(self, chat_id, text):
+		self.tg.send_message(chat_id, text, parse_mode="HTML")
+
+	def _serve_file(self, file_id, extension, kind=None, hook=None, allowed_failure=False):
+		if self.web.lazy and hook is None:
+			# URL is handed out now, the file is only fetched once someone opens it
+			return self.web.serve_lazy(file_id, self.tg.get_file_url, extension=extension, kind=kind)
+		instrument.mark("format")
+		remote = self.tg.get_file_url(file_id, allowed_failure=allowed_failure)
+		instrument.mark("get_file")
+		if remote is not None:
+			url = self.web.download_and_serve(remote, extension=extension, hook=hook, kind=kind)
+			instrument.mark("download")
+			if url is not None:
+				return url
+		return "" if allowed_failure else "<error>"
+
+	def _serve_preview(self, media):
+		# Serves the largest of Telegram's smaller variants that fits
+		# media_preview_size, the same file is only stored once
+		size = self.conf.media_preview_size
+		if size <= 0 or media.type not in PREVIEW_TYPES or self.web.type == "stub":
+			return None
+		if media.type == "photo" and max(media.dimensions) <= size:
+			return None # original is small enough
+		p = next((p for p in media.previews if max(p.width, p.height) <= size), None)
+		if p is None:
+			return None
+		with self.previews_lock:
+			url = self.previews.get(p.file_unique_id)
+			if url is not None:
+				self.previews.move_to_end(p.file_unique_id)
+				return url
+		url = self._serve_file(p.file_id, "jpg", kind="preview", allowed_failure=True)
+		if not url:
+			return None
+		with self.previews_lock:
+			self.previews[p.file_unique_id] = url
+			while len(self.previews) > PREVIEW_CACHE_MAX:
+				self.previews.popitem(last=False)
+		return url
 
 
 	def irc_connected(self):
-		for l in self.links:
+		for l in self.routing.links:
 			self.irc.join(l.irc)
 
 	def irc_message(self, l, event):
 		logging.info("[IRC] %s in %s says: %s", event.nick, event.channel, event.message)
-		if self.conf.telegram_bold_nicks:
-			fmt = "&lt;<b>%s</b>&gt; %s"
-		else:
-			fmt = "&lt;%s&gt; %s"
-		msg = fmt % (event.nick, self.tf.irc.convert(event.message))
-		self.tg.send_message(l.telegram, msg, parse_mode="HTML")
+		msg = self.tpl["irc_message"](nick=event.nick, text=self._irc_mentions(l, self.tf.irc.convert(event.message)))
+		self._tg_send(l, PRIO_CHAT, msg)
 
 	def irc_action(self, l, event):
 		logging.info("[IRC] %s in %s does action: %s", event.nick, event.channel, event.message)
-		if self.conf.telegram_bold_nicks:
-			fmt = "* <b>%s</b> %s"
-		else:
-			fmt = "* %s %s"
-		msg = fmt % (event.nick, self.tf.irc.convert(event.message))
-		self.tg.send_message(l.telegram, msg, parse_mode="HTML")
+		msg = self.tpl["irc_action"](nick=event.nick, text=self._irc_mentions(l, self.tf.irc.convert(event.message)))
+		self._tg_send(l, PRIO_CHAT, msg)
 
 	def irc_join(self, l, event):
 		logging.info("[IRC] %s joins %s", event.nick, event.channel)
 		if not self.conf.telegram_show_joins:
 			return
-		if self.conf.telegram_bold_nicks:
-			fmt = "<b>%s</b> has joined"
-		else:
-			fmt = "%s has joined"
-		self.tg.send_message(l.telegram, fmt % event.nick, parse_mode="HTML")
+		self.joins.add(l, "join", event.nick)
 
 	def irc_part(self, l, event):
 		logging.info("[IRC] %s leaves %s", event.nick, event.channel)
 		if not self.conf.telegram_show_joins:
 			return
-		if self.conf.telegram_bold_nicks:
-			fmt = "<b>%s</b> has left"
+		self.joins.add(l, "part", event.nick)
+
+	def irc_quit(self, l, event):
+		logging.info("[IRC] %s quits (%s)", event.nick, event.message)
+		if not self.conf.telegram_show_joins:
+			return
+		self.joins.add(l, "quit", event.nick, event.message)
+
+	def _tg_send_membership(self, l, kind, nick, reason):
+		if kind == "quit" and reason:
+			msg = self.tpl["irc_quit_reason"](nick=nick, reason=self.tf.irc.convert(reason))
 		else:
-			fmt = "%s has left"
-		self.tg.send_message(l.telegram, fmt % event.nick, parse_mode="HTML")
+			msg = self.tpl["irc_" + kind](nick=nick)
+		self._tg_send(l, PRIO_EVENT, msg)
+
+	def _tg_send_membership_summary(self, l, summary):
+		logging.info("[IRC] %s in %s", summary, l.irc)
+		self._tg_send(l, PRIO_EVENT, self.tpl["irc_summary"](summary=html.escape(summary)))
 
 	def irc_kick(self, l, event):
 		logging.info("[IRC] %s kicks %s", event.nick, event.othernick)
-		if self.conf.telegram_bold_nicks:
-			fmt = "<b>%s</b> was kicked by <b>%s</b>"
-		else:
-			fmt = "%s was kicked by %s"
-		self.tg.send_message(l.telegram, fmt % (event.othernick, event.nick), parse_mode="HTML")
+		self._tg_send(l, PRIO_EVENT, self.tpl["irc_kick"](othernick=event.othernick, nick=event.nick))
 
 
 	def tg_help(self, event):
@@ -369,184 +625,304 @@ class Bridge():
 		# TODO consider supporting formatting here
 		atext = " ".join(event.text.split(" ")[1:])
 		logging.info("[TG] /me action: %s", atext)
-		self.irc.privmsg(l.irc, self._tg_format_msg_prefix(event, True) + " " + atext)
+		self._irc_send(l, PRIO_CHAT, self.tpl["tg_message"](
+			prefix=self._tg_format_msg_prefix(event, True), text=atext))
 
 	def tg_text(self, l, event):
 		logging.info("[TG] text: %s", event.text)
-		self.irc.privmsg(l.irc, self._tg_format_msg(event))
-
-	def tg_media(self, l, event, media):
+		if self._is_paste(event.text):
+			url = self._tg_serve_paste(event)
+			if url is not None:
+				lines = event.text.strip().split("\n")
+				preview = lines[0][:PASTE_PREVIEW_LEN]
+				if len(lines) > 1 or len(lines[0]) > PASTE_PREVIEW_LEN:
+					preview += " …"
+				self._irc_send(l, PRIO_CHAT, self.tpl["tg_paste"](prefix=self._tg_format_msg_prefix(event),
+					preview=preview, lines=len(lines), url=url))
+				return
+		self._irc_send(l, PRIO_CHAT, self._tg_format_msg(l, event))
+
+	def _is_paste(self, text):
+		if self.web.type == "stub":
+			return False
+		if self.conf.paste_max_lines > 0 and text.count("\n") >= self.conf.paste_max_lines:
+			return True
+		return self.conf.paste_max_bytes > 0 and len(text.encode("utf-8")) > self.conf.paste_max_bytes
+
+	def _tg_serve_paste(self, event):
+		u = event.sender
+		title = "Message from " + (u.username or " ".join(filter(None, (u.first_name, u.last_name))))
+		body = to_html(event.text, event.entities)
+		return self.web.serve_text(PASTE_TEMPLATE % (html.escape(title), body))
+
+	def tg_media(self, l, event):
+		media = event.media
 		logging.info("[TG] media (%s)", media.type)
 		parts = []
 		# main description + determine file extension
 		mediadesc = ""
 		mediaext = media.extension
 		dl_allowed_failure = False
+		tpl = self.tpl
 		if media.type == "audio":
 			if media.desc is not None and self.conf.forward_audio_description:
-				mediadesc = "(Audio, %s: %s)" % (format_duration(media.duration), media.desc)
+				mediadesc = tpl["media_audio_desc"](duration=format_duration(media.duration), desc=media.desc)
 			else:
-				mediadesc = "(Audio, %s)" % format_duration(media.duration)
+				mediadesc = tpl["media_audio"](duration=format_duration(media.duration))
 		elif media.type == "animation":
-			mediadesc = "(GIF)"
+			mediadesc = tpl["media_animation"]()
 			mediaext = {"video/mp4": "mp4", "image/gif": "gif"}[media.mime]
 		elif media.type == "document":
 			if self.conf.forward_document_mime:
-				mediadesc = "(Document, %s, %s)" % (media.mime, format_filesize(media.file_size))
+				mediadesc = tpl["media_document_mime"](mime=media.mime,
+					size=format_filesize(media.file_size), filename=media.filename)
 			else:
-				mediadesc = "(Document, %s)" % format_filesize(media.file_size)
-			mediadesc += " \"%s\"" % media.filename
+				mediadesc = tpl["media_document"](size=format_filesize(media.file_size), filename=media.filename)
 			mediaext = media.filename.split(".")[-1]
 			dl_allowed_failure = True
 		elif media.type == "photo":
-			mediadesc = "(Photo, %dx%d)" % media.dimensions
+			mediadesc = tpl["media_photo"](width=media.dimensions[0], height=media.dimensions[1])
 		elif media.type == "sticker":
+			name = "media_sticker_animated" if media.is_animated else "media_sticker"
 			if self.conf.forward_sticker_dimensions:
-				mediadesc = "(Sticker, %dx%d)" % media.dimensions
+				mediadesc = tpl[name + "_dims"](width=media.dimensions[0], height=media.dimensions[1])
 			else:
-				mediadesc = "(Sticker)"
+				mediadesc = tpl[name]()
 			if self.conf.forward_sticker_emoji and media.emoji is not None:
-				mediadesc += " " + media.emoji
+				mediadesc = tpl["media_sticker_emoji"](desc=mediadesc, emoji=media.emoji)
 			if media.is_animated: # TODO: do this better someday
-				mediadesc = "(Animated " + mediadesc[1:]
-				self.irc.privmsg(l.irc, self._tg_format_msg_prefix(event) + " " + mediadesc)
+				self._irc_send(l, PRIO_MEDIA, tpl["tg_media"](
+					prefix=self._tg_format_msg_prefix(event), desc=mediadesc))
 				return
 		elif media.type == "video":
-			mediadesc = "(Video, %s)" % format_duration(media.duration)
+			mediadesc = tpl["media_video"](duration=format_duration(media.duration))
 		elif media.type == "video_note":
-			mediadesc = "(Video Note, %s)" % format_duration(media.duration)
+			mediadesc = tpl["media_video_note"](duration=format_duration(media.duration))
 		elif media.type == "voice":
-			mediadesc = "(Voice, %s)" % format_duration(media.duration)
+			mediadesc = tpl["media_voice"](duration=format_duration(media.duration))
 		parts.append(mediadesc)
 		#
 		if event.via_bot is not None:
-			parts.append("via @" + self._tg_format_user(event.via_bot))
+			parts.append(tpl["tg_via"](user=self._tg_format_user(event.via_bot)))
 		# download file and generate URL
-		remote = self.tg.get_file_url(media.file_id, allowed_failure=dl_allowed_failure)
-		if remote is None:
-			url = "" if dl_allowed_failure else "<error>"
-		elif self.conf.convert_webp_stickers and media.type == "sticker":
-			url = self.web.download_and_serve(remote, extension=mediaext, hook=WebpConverter.hook)
+		if self.conf.convert_webp_stickers and media.type == "sticker":
+			hook = WebpConverter.hook
 		else:
-			url = self.web.download_and_serve(remote, extension=mediaext)
+			hook = None
+		url = self._serve_file(media.file_id, mediaext, kind=media.type,
+			hook=hook, allowed_failure=dl_allowed_failure)
+		preview = self._serve_preview(media)
+		if preview is not None:
+			url = tpl["media_preview"](preview=preview, url=url)
 		parts.append(url)
 		#
-		if event.caption is not None:
-			parts.append(self.tf.tg.convert(event.caption, event.caption_entities))
+		if event.text is not None: # caption
+			parts.append(self._tg_convert(l, event))
 		#
 		full = " ".join(filter(None, parts))
-		self.irc.privmsg(l.irc, self._tg_format_msg_prefix(event) + " " + full)
+		self._irc_send(l, PRIO_MEDIA, tpl["tg_media"](prefix=self._tg_format_msg_prefix(event), desc=full))
 
 	def tg_location(self, l, event):
 		logging.info("[TG] location")
-		self.irc.privmsg(l.irc, "%s (Location, lat: %.4f, lon: %.4f)" % (
-			self._tg_format_msg_prefix(event),
-			event.location.latitude,
-			event.location.longitude,
+		self._irc_send(l, PRIO_MEDIA, self.tpl["tg_location"](
+			prefix=self._tg_format_msg_prefix(event),
+			lat="%.4f" % event.payload.latitude,
+			lon="%.4f" % event.payload.longitude,
 		))
 
 	def tg_venue(self, l, event):
 		logging.info("[TG] venue")
 		url = ""
-		if event.venue.foursquare_id is not None:
-			url = ", http://foursquare.com/v/" + event.venue.foursquare_id
-		self.irc.privmsg(l.irc, "%s (Venue, %s: %s%s)" % (
-			self._tg_format_msg_prefix(event),
-			event.venue.title,
-			event.venue.address,
-			url
+		venue = event.payload
+		if venue.foursquare_id is not None:
+			url = self.tpl["venue_url"](id=venue.foursquare_id)
+		self._irc_send(l, PRIO_MEDIA, self.tpl["tg_venue"](
+			prefix=self._tg_format_msg_prefix(event),
+			title=venue.title,
+			address=venue.address,
+			url=url,
 		))
 
 	def tg_contact(self, l, event):
 		logging.info("[TG] contact")
-		self.irc.privmsg(l.irc, "%s (Contact, Name: %s%s, Phone: %s)" % (
-			self._tg_format_msg_prefix(event),
-			event.contact.first_name,
-			(" " + event.contact.last_name) if event.contact.last_name is not None else "",
-			event.contact.phone_number,
+		self._irc_send(l, PRIO_MEDIA, self.tpl["tg_contact"](
+			prefix=self._tg_format_msg_prefix(event),
+			name=event.payload.first_name +
+				((" " + event.payload.last_name) if event.payload.last_name is not None else ""),
+			phone=event.payload.phone_number,
 		))
 
 	def tg_game(self, l, event):
 		logging.info("[TG] game")
-		gamedesc = "\"%s\"" % event.game.title
-		if event.game.description is not None:
-			gamedesc += ": " + event.game.description
-		self.irc.privmsg(l.irc, "%s (Game, %s)" % (self._tg_format_msg_prefix(event), gamedesc))
+		game = event.payload
+		if game.description is not None:
+			gamedesc = self.tpl["game_desc_long"](title=game.title, description=game.description)
+		else:
+			gamedesc = self.tpl["game_desc"](title=game.title)
+		self._irc_send(l, PRIO_MEDIA, self.tpl["tg_game"](prefix=self._tg_format_msg_prefix(event), desc=gamedesc))
 
 	def tg_poll(self, l, event):
 		logging.info("[TG] poll")
-		polldesc = ""
-		if event.poll.is_anonymous:
-			polldesc += "Anonymous "
-		polldesc += "Quiz" if event.poll.type == "quiz" else "Poll"
-		if event.poll.is_closed:
-			polldesc += " closed"
-		showvotes = event.poll.is_closed or event.poll.total_voter_count > 0
+		poll = event.payload
+		counts = [option.voter_count for option in poll.options]
+		# the same poll can be forwarded to several linked chats
+		key = (l.telegram, poll.id)
+		prev = None
+		with self.polls_lock:
+			state = self.polls.get(key)
+			if state is None or (poll.is_closed and not state.closed):
+				# first time we see it or final result
+				if state is not None:
+					state.cancel()
+				state = self.polls[key] = PollState(counts, poll.is_closed)
+			elif state.closed or counts == state.counts:
+				state.pending = None
+				return
+			else:
+				wait = self.conf.poll_update_interval - (time.monotonic() - state.last_sent)
+				if wait > 0:
+					# throttled, the latest counts are sent once the interval is over
+					state.pending = poll
+					if state.timer is None:
+						state.timer = threading.Timer(wait, self._tg_poll_flush, (key, ))
+						state.timer.daemon = True
+						state.timer.start()
+					return
+				prev = state.counts
+				state.cancel()
+				state.counts = counts
+				state.last_sent = time.monotonic()
+			self.polls.move_to_end(key)
+			while len(self.polls) > POLL_STATE_MAX:
+				self.polls.popitem(last=False)[1].cancel()
+		if prev is None:
+			polldesc, polldetail = self._tg_format_poll(poll)
+			self._irc_send(l, PRIO_MEDIA, self.tpl["tg_poll"](
+				prefix=self._tg_format_msg_prefix(event), desc=polldesc, detail=polldetail))
+			return
+		self._tg_send_poll_update(l, poll, prev)
+
+	def _tg_poll_flush_all(self):
+		with self.polls_lock:
+			keys = [key for key, state in self.polls.items() if state.timer is not None]
+			for key in keys:
+				self.polls[key].timer.cancel()
+		ok = True
+		for key in keys:
+			ok = self._tg_poll_flush(key) and ok
+		return ok
+
+	def _tg_poll_flush(self, key):
+		# returns False if a pending update couldn't be sent
+		with self.polls_lock:
+			state = self.polls.get(key)
+			if state is None:
+				return True
+			state.timer = None
+			poll = state.pending
+			if poll is None:
+				return True
+			prev = state.counts
+			state.pending = None
+			state.counts = [option.voter_count for option in poll.options]
+			state.last_sent = time.monotonic()
+		l = self.routing.by_tg.get(key[0])
+		if l is None:
+			return True # no longer linked
+		try:
+			self._tg_send_poll_update(l, poll, prev)
+		except Exception:
+			logging.exception("Failed to send poll update")
+			return False
+		return True
+
+	def _tg_send_poll_update(self, l, poll, prev):
+		# only mention the options whose votes changed
+		tpl = self.tpl
+		bold = "\x02" if self.nc.enabled() else ""
+		polldetail = tpl["poll_question"](question=poll.question)
+		for option, old in zip(poll.options, prev):
+			if option.voter_count != old:
+				polldetail += tpl["poll_option_change"](text=option.text, bold=bold,
+					votes=option.voter_count, change="%+d" % (option.voter_count - old))
+		self._irc_send(l, PRIO_EVENT, tpl["tg_poll_update"](kind=self._tg_poll_kind(poll),
+			votes=poll.total_voter_count, detail=polldetail))
+
+	def _tg_poll_kind(self, poll):
+		return self.tpl["poll_quiz" if poll.type == "quiz" else "poll_regular"]()
+
+	def _tg_format_poll(self, poll):
+		tpl = self.tpl
+		polldesc = self._tg_poll_kind(poll)
+		if poll.is_anonymous:
+			polldesc = tpl["poll_anonymous"](kind=polldesc)
+		if poll.is_closed:
+			polldesc = tpl["poll_closed"](kind=polldesc)
+		showvotes = poll.is_closed or poll.total_voter_count > 0
 		if showvotes:
-			polldesc += " with %d votes" % event.poll.total_voter_count
-		if event.poll.allows_multiple_answers:
-			polldesc += ", multi-choice"
+			polldesc = tpl["poll_votes"](kind=polldesc, votes=poll.total_voter_count)
+		if poll.allows_multiple_answers:
+			polldesc = tpl["poll_multi"](kind=polldesc)
 		#
-		polldetail = "\"%s\"" % event.poll.question
+		polldetail = tpl["poll_question"](question=poll.question)
 		bold = "\x02" if self.nc.enabled() else ""
-		for option in event.poll.options:
-			polldetail += " … " + option.text
+		for option in poll.options:
 			if showvotes:
-				polldetail += " %s(%d)%s" % (bold, option.voter_count, bold)
-		#
-		self.irc.privmsg(l.irc, "%s (%s) %s" % (
-			self._tg_format_msg_prefix(event), polldesc, polldetail))
+				polldetail += tpl["poll_option_votes"](text=option.text, bold=bold, votes=option.voter_count)
+			else:
+				polldetail += tpl["poll_option"](text=option.text)
+		return polldesc, polldetail
 
 	def tg_users_joined(self, l, event):
+		for member in event.payload:
+			self.tg_users.add(event.chat_id, member)
 		if not self.conf.irc_show_added_users:
 			return
-		for member in event.new_chat_members:
+		for member in event.payload:
 			logging.info("[TG] user joined: %d", member.id)
-			if event.from_user.id == member.id:
-				self.irc.privmsg(l.irc, "%s has joined" % self._tg_format_user(member))
+			if event.sender.id == member.id:
+				self._irc_send(l, PRIO_EVENT, self.tpl["tg_user_joined"](user=self._tg_format_user(member)))
 			else:
-				self.irc.privmsg(l.irc, "%s was added by %s" % (
-					self._tg_format_user(member),
-					self._tg_format_user(event.from_user),
+				self._irc_send(l, PRIO_EVENT, self.tpl["tg_user_added"](
+					user=self._tg_format_user(member),
+					by=self._tg_format_user(event.sender),
 				))
 
 	def tg_user_left(self, l, event):
-		logging.info("[TG] user left: %d", event.left_chat_member.id)
+		logging.info("[TG] user left: %d", event.payload.id)
 		if not self.conf.irc_show_added_users:
 			return
-		if event.from_user.id == event.left_chat_member.id:
-			self.irc.privmsg(l.irc, "%s has left" % self._tg_format_user(event.from_user))
+		if event.sender.id == event.payload.id:
+			self._irc_send(l, PRIO_EVENT, self.tpl["tg_user_left"](user=self._tg_format_user(event.sender)))
 		else:
-			self.irc.privmsg(l.irc, "%s was removed by %s" % (
-				self._tg_format_user(event.left_chat_member),
-				self._tg_format_user(event.from_user),
+			self._irc_send(l, PRIO_EVENT, self.tpl["tg_user_removed"](
+				user=self._tg_format_user(event.payload),
+				by=self._tg_format_user(event.sender),
 			))
 
 	def tg_ctitle_changed(self, l, event):
-		logging.info("[TG] chat title changed: %s", event.new_chat_title)
-		self.irc.privmsg(l.irc, "%s set a new chat title: %s" % (
-			self._tg_format_user(event.from_user),
-			event.new_chat_title,
+		logging.info("[TG] chat title changed: %s", event.payload)
+		self._irc_send(l, PRIO_EVENT, self.tpl["tg_title_changed"](
+			user=self._tg_format_user(event.sender),
+			title=event.payload,
 		))
 
-	def tg_cphoto_changed(self, l, event, media):
+	def tg_cphoto_changed(self, l, event):
+		media = event.media
 		logging.info("[TG] chat photo changed")
-		remote = self.tg.get_file_url(media.file_id)
-		url = self.web.download_and_serve(remote, extension=media.extension)
-		self.irc.privmsg(l.irc, "%s set a new chat photo (%dx%d): %s" % (
-			self._tg_format_user(event.from_user),
-			media.dimensions[0], media.dimensions[1], url
+		url = self._serve_file(media.file_id, media.extension, kind="photo")
+		self._irc_send(l, PRIO_EVENT, self.tpl["tg_photo_changed"](
+			user=self._tg_format_user(event.sender),
+			width=media.dimensions[0], height=media.dimensions[1], url=url,
 		))
 
 	def tg_cphoto_deleted(self, l, event):
 		logging.info("[TG] chat photo deleted")
-		self.irc.privmsg(l.irc, "%s deleted the chat photo" % (
-			self._tg_format_user(event.from_user),
-		))
+		self._irc_send(l, PRIO_EVENT, self.tpl["tg_photo_deleted"](user=self._tg_format_user(event.sender)))
 
 	def tg_cpinned_changed(self, l, event):
 		logging.info("[TG] pinned message changed")
-		self.irc.privmsg(l.irc, "%s pinned message: %s" % (
-			self._tg_format_user(event.from_user),
-			self._tg_format_msg(event.pinned_message),
+		self._irc_send(l, PRIO_EVENT, self.tpl["tg_pinned"](
+			user=self._tg_format_user(event.sender),
+			text=self._tg_format_msg(l, event.payload),
 		))
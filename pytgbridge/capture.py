@@ -0,0 +1,59 @@
+import re
+import json
+import gzip
+import time
+import threading
+
+FLUSH_INTERVAL = 1
+
+# Bot API tokens and phone numbers in international format
+token_re = re.compile(r"\b\d{6,12}:[A-Za-z0-9_-]{30,}")
+phone_re = re.compile(r"\+\d[\d ()-]{6,}\d")
+phone_field_re = re.compile(r'("phone_number":")[^"]*(")')
+
+def redact(s):
+	s = token_re.sub("<token>", s)
+	s = phone_field_re.sub(r"\1<phone>\2", s)
+	return phone_re.sub("<phone>", s)
+
+class CaptureWriter():
+	# Appends incoming traffic to a gzip file, one JSON record per line:
+	# [unix time, "tg" or "irc", raw update / raw IRC line]
+	# Each run appends a new gzip member, so the file stays readable as one.
+	def __init__(self, path, redact=False):
+		self.f = gzip.open(path, "at", encoding="utf-8")
+		self.redact = redact
+		self.lock = threading.Lock()
+		self.last_flush = time.monotonic()
+		self.records = 0
+
+	def write(self, source, payload):
+		line = json.dumps([round(time.time(), 3), source, payload], separators=(",", ":"), ensure_ascii=False)
+		if self.redact:
+			line = redact(line)
+		with self.lock:
+			if self.f is None:
+				return
+			self.f.write(line + "\n")
+			self.records += 1
+			now = time.monotonic()
+			if now - self.last_flush >= FLUSH_INTERVAL:
+				self.f.flush()
+				self.last_flush = now
+
+	def close(self):
+		with self.lock:
+			if self.f is not None:
+				self.f.close()
+				self.f = None
+
+def read_capture(path):
+	# a capture cut short by a crash ends in a truncated record/gzip member
+	with gzip.open(path, "rt", encoding="utf-8") as f:
+		try:
+			for line in f:
+				if line.strip() == "":
+					continue
+				yield json.loads(line)
+		except (EOFError, ValueError):
+			return
@@ -0,0 +1,64 @@
+import time
+import queue
+import logging
+import threading
+
+from . import instrument
+
+class Dispatcher():
+	# Runs handlers on a fixed pool of workers. Events are assigned to a
+	# worker by their key (the link), so events of one link are handled in
+	# order while different links are handled in parallel.
+	def __init__(self, workers, queue_size=0):
+		self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+		self.high_water = [0] * workers
+		for i in range(workers):
+			t = threading.Thread(target=self._run, args=(i, ), name="dispatch-%d" % i, daemon=True)
+			t.start()
+
+	def submit(self, key, func, *args):
+		if not self.queues: # run inline
+			func(*args)
+			return
+		i = hash(key) % len(self.queues)
+		q = self.queues[i]
+		q.put((func, args, instrument.detach())) # blocks if the worker is too far behind
+		depth = q.qsize()
+		if depth > self.high_water[i]:
+			self.high_water[i] = depth
+
+	def depths(self):
+		return [q.qsize() for q in self.queues]
+
+	def describe(self):
+		# current depth/highest depth seen, per worker
+		return " ".join("%d/%d" % (d, hw) for d, hw in zip(self.depths(), self.high_water)) or "inline"
+
+	def join(self, timeout=None):
+		# Waits for all submitted events to be handled, False on timeout
+		deadline = None if timeout is None else time.monotonic() + timeout
+		for q in self.queues:
+			with q.all_tasks_done:
+				while q.unfinished_tasks:
+					if deadline is None:
+						q.all_tasks_done.wait()
+						continue
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						return False
+					q.all_tasks_done.wait(remaining)
+		return True
+
+	def _run(self, i):
+		q = self.queues[i]
+		while True:
+			func, args, timer = q.get()
+			instrument.resume(timer)
+			instrument.mark("queue")
+			try:
+				func(*args)
+			except Exception:
+				logging.exception("Exception in event handler")
+			finally:
+				instrument.end()
+				q.task_done()
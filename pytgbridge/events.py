@@ -0,0 +1,86 @@
+import html
+from collections import namedtuple
+
+# Compact representation of Telegram events, filled in by TelegramClient so
+# the bridge never holds on to telebot objects.
+
+class User():
+	__slots__ = ("id", "username", "first_name", "last_name")
+	def __init__(self, id, username=None, first_name="", last_name=None):
+		self.id = id
+		self.username = username
+		self.first_name = first_name
+		self.last_name = last_name
+
+class Entity():
+	__slots__ = ("type", "offset", "length", "url", "user")
+	def __init__(self, type, offset, length, url=None, user=None):
+		self.type = type
+		self.offset = offset
+		self.length = length
+		self.url = url
+		self.user = user
+
+class Message():
+	__slots__ = ("kind", "chat_id", "chat_type", "message_id", "sender", "link",
+		"text", "entities", "media", "reply_to", "forward_from", "via_bot", "payload")
+	def __init__(self, kind, chat_id=None, chat_type=None, message_id=None, sender=None,
+			text=None, entities=None, media=None, reply_to=None, forward_from=None,
+			via_bot=None, payload=None):
+		self.kind = kind # content type, e.g. "text", "photo", "new_chat_title"
+		self.chat_id = chat_id
+		self.chat_type = chat_type
+		self.message_id = message_id
+		self.sender = sender # User
+		self.link = None # filled in by the bridge
+		self.text = text # message text or caption
+		self.entities = entities # list of Entity
+		self.media = media # TelegramMediaContainer
+		self.reply_to = reply_to # Message (only sender and text)
+		self.forward_from = forward_from # User or name of chat/sender
+		self.via_bot = via_bot # User
+		self.payload = payload # depends on kind, see below
+
+# payloads
+Location = namedtuple("Location", ["latitude", "longitude"])
+Venue = namedtuple("Venue", ["title", "address", "foursquare_id"])
+Contact = namedtuple("Contact", ["first_name", "last_name", "phone_number"])
+Game = namedtuple("Game", ["title", "description"])
+PollOption = namedtuple("PollOption", ["text", "voter_count"])
+# smaller variant of a photo or a thumbnail, see TelegramMediaContainer.previews
+PhotoSize = namedtuple("PhotoSize", ["file_id", "file_unique_id", "width", "height"])
+Poll = namedtuple("Poll", ["id", "question", "options", "total_voter_count", "is_closed",
+	"is_anonymous", "type", "allows_multiple_answers"])
+
+html_tags = {
+	"bold": ("<b>", "</b>"),
+	"italic": ("<i>", "</i>"),
+	"underline": ("<u>", "</u>"),
+	"strikethrough": ("<s>", "</s>"),
+	"spoiler": ("<span class=\"tg-spoiler\">", "</span>"),
+	"code": ("<code>", "</code>"),
+	"pre": ("<pre>", "</pre>"),
+}
+
+def to_html(text, entities):
+	_enc = "utf-16-le"
+	if not entities:
+		return html.escape(text)
+	# Telegrams entities are positioned in units of UTF-16 code points
+	text = text.encode(_enc)
+	ret = ""
+	tpos = 0
+	for e in sorted(entities, key=lambda e: e.offset):
+		start, end = e.offset << 1, (e.offset + e.length) << 1
+		if start < tpos: # nested/overlapping, not supported
+			continue
+		ret += html.escape(text[tpos:start].decode(_enc))
+		etext = html.escape(text[start:end].decode(_enc))
+		if e.type in html_tags:
+			ret += html_tags[e.type][0] + etext + html_tags[e.type][1]
+		elif e.type == "text_link":
+			ret += "<a href=\"%s\">%s</a>" % (html.escape(e.url), etext)
+		else:
+			ret += etext
+		tpos = end
+	return ret + html.escape(text[tpos:].decode(_enc))
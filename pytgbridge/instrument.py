@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.005
+
+# Per-event stage timing. A timer is started when a transport receives an
+# event, follows it to the dispatcher worker and is checked once the
+# handler is done. Handlers mark the end of each stage with mark().
+
+slow_threshold = None # seconds, None = don't log slow handlers
+context = None # returns extra state for the slow handler warning (set by the bridge)
+observer = None # called with each finished StageTimer (used by replay)
+
+_local = threading.local()
+
+class StageTimer():
+	__slots__ = ("name", "start", "last", "stages")
+	def __init__(self, name):
+		self.name = name
+		self.start = self.last = time.monotonic()
+		self.stages = {} # name -> seconds, in order of first occurrence
+	def mark(self, stage):
+		now = time.monotonic()
+		self.stages[stage] = self.stages.get(stage, 0) + (now - self.last)
+		self.last = now
+	def elapsed(self):
+		return self.last - self.start
+	def describe(self):
+		return ", ".join("%s %.1fms" % (k, v * 1000) for k, v in self.stages.items())
+
+def begin(name):
+	t = StageTimer(name)
+	_local.timer = t
+	return t
+
+def mark(stage):
+	t = getattr(_local, "timer", None)
+	if t is not None:
+		t.mark(stage)
+
+def detach():
+	# Hands the current timer over to another thread, see resume()
+	t = getattr(_local, "timer", None)
+	_local.timer = None
+	return t
+
+def resume(t):
+	_local.timer = t
+
+def end(stage="handler"):
+	t = detach()
+	if t is None:
+		return
+	t.mark(stage)
+	if observer is not None:
+		observer(t)
+	if slow_threshold is not None and t.elapsed() >= slow_threshold:
+		extra = "" if context is None else "; " + context()
+		logging.warning("Slow '%s' event: %.0fms (%s%s)", t.name, t.elapsed() * 1000, t.describe(), extra)
+
+# Startup report: __main__ sets a timer for its phases, a few milestones
+# are logged relative to it until the first message has been sent.
+
+startup = None
+
+def milestone(name, final=False):
+	global startup
+	t = startup
+	if t is None:
+		return
+	logging.info("Startup: %s after %.0fms", name, (time.monotonic() - t.start) * 1000)
+	if final:
+		startup = None
+
+# Sampling profiler: records the stacks of all threads at a fixed interval
+# and writes them in the "collapsed" format understood by flamegraph.pl,
+# speedscope and others.
+
+_profile_lock = threading.Lock()
+
+def _label(code, cache):
+	s = cache.get(code)
+	if s is None:
+		s = "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+		cache[code] = s = s.replace(";", ":")
+	return s
+
+def sample(duration, interval=SAMPLE_INTERVAL):
+	stacks = Counter()
+	labels = {}
+	me = threading.get_ident()
+	names = {}
+	deadline = time.monotonic() + duration
+	n = 0
+	while time.monotonic() < deadline:
+		if n % 200 == 0: # threads come and go
+			names = {t.ident: t.name for t in threading.enumerate()}
+		for ident, frame in sys._current_frames().items():
+			if ident == me:
+				continue
+			stack = []
+			while frame is not None:
+				stack.append(_label(frame.f_code, labels))
+				frame = frame.f_back
+			stack.append(names.get(ident, "thread-%d" % ident))
+			stacks[";".join(reversed(stack))] += 1
+		n += 1
+		time.sleep(interval)
+	return stacks, n
+
+def profile(duration):
+	if not _profile_lock.acquire(blocking=False):
+		logging.warning("Profiler is already running")
+		return None
+	try:
+		logging.info("Profiling all threads for %ds", duration)
+		start = time.monotonic()
+		stacks, n = sample(duration)
+		path = os.path.join(tempfile.gettempdir(), "pytgbridge-%d-%d.folded" % (os.getpid(), time.time()))
+		with open(path, "w") as f:
+			for stack, count in stacks.most_common():
+				f.write("%s %d\n" % (stack, count))
+		logging.info("Wrote profile to %s (%d samples, %.1f ms per sample)", path, n,
+			(time.monotonic() - start) * 1000 / max(n, 1))
+		return path
+	finally:
+		_profile_lock.release()
@@ -1,39 +1,118 @@
 import irc.connection
+import irc.client
 import irc.bot
 import socket
 import logging
 import time
+import itertools
+from collections import deque
+from datetime import datetime, timezone
 from jaraco.stream import buffer
+from . import instrument
 
 MESSAGE_SPLIT_LEN = 420
 
+# IRCv3 capabilities we make use of, if the server offers them
+wanted_caps = ("server-time", "batch", "echo-message", "message-tags", "draft/multiline")
+
+# RFC 1459 casemapping, like irc.strings but on plain str (much faster)
+_casemap = str.maketrans("[]\\^", "{}|~")
+def irc_lower(s):
+	return s.lower().translate(_casemap)
+
+def _tags(event):
+	return {t["key"]: t["value"] for t in event.tags or ()}
+
+def parse_server_time(value):
+	for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+		try:
+			return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc).timestamp()
+		except ValueError:
+			pass
+	return None
+
 class IRCEvent():
-	def __init__(self, orig, argname="message"):
-		self.nick, self.mask = orig.source.split("!")
-		self.channel = orig.target if orig.target.startswith("#") else None
-		setattr(self, argname, orig.arguments[0] if len(orig.arguments) > 0 else None)
+	__slots__ = ("nick", "mask", "channel", "link", "message", "othernick", "time", "msgid")
+	def __init__(self, orig, argname="message", channel=None, tags=None):
+		self.nick, _, self.mask = orig.source.partition("!")
+		if channel is None and orig.target is not None and orig.target.startswith("#"):
+			channel = orig.target
+		self.channel = channel
+		self.link = None # filled in by the bridge
+		arg = orig.arguments[0] if len(orig.arguments) > 0 else None
+		if argname == "othernick":
+			self.othernick = arg
+			self.message = orig.arguments[1] if len(orig.arguments) > 1 else None
+		else:
+			self.othernick = None
+			self.message = arg
+		if tags is None:
+			tags = _tags(orig)
+		st = tags.get("time")
+		self.time = time.time() if st is None else (parse_server_time(st) or time.time())
+		self.msgid = tags.get("msgid")
+
+class CapServerConnection(irc.client.ServerConnection):
+	# Asks for the server's capabilities before registering. Servers without
+	# CAP support just ignore it (or reply with 421) and register as usual.
+	def __init__(self, reactor):
+		super().__init__(reactor)
+		self.registering = False
+	def connect(self, *args, **kwargs):
+		self.registering = True
+		return super().connect(*args, **kwargs)
+	def nick(self, newnick):
+		if self.registering:
+			self.registering = False
+			self.send_raw("CAP LS 302")
+		super().nick(newnick)
+
+class CapReactor(irc.client.Reactor):
+	connection_class = CapServerConnection
 
 class IRCBot(irc.bot.SingleServerIRCBot):
-	def __init__(self, args, kwargs=None, ns_password=None):
+	def __init__(self, args, kwargs=None, ns_password=None, ircv3=True):
 		kwargs = kwargs or {}
+		if ircv3:
+			self.reactor_class = CapReactor
 		irc.bot.SingleServerIRCBot.__init__(self, *args, **kwargs)
 		self.connection.buffer_class = buffer.LenientDecodingLineBuffer
 		self.event_handlers = {}
 		self.ns_password = ns_password
+		self.stopping = False
+		self.caps_offered = {} # name -> value
+		self.caps = {} # acknowledged
+		self.batches = {} # reference -> list of events (multiline batches only)
+		self.unconfirmed = deque() # send times of messages not yet echoed back
+		self.echo_rtt = None
+		self.lag = None # latest difference between server-time and our clock
+		# irc.bot tracks channel members too, but its case-insensitive dicts
+		# are too slow for looking up every mention
+		self.members = {} # casemapped channel -> set of casemapped nicks
+		self.real_nicks = {} # casemapped nick -> nick as the server spells it (if different)
+		# needs to run before irc.bot forgets which channels the user was in
+		self.connection.add_global_handler("quit", self._before_quit, -30)
+		for i in ("join", "namreply", "nick", "part", "kick", "quit"):
+			self.connection.add_global_handler(i, self._track_members, -10)
 
 	def _invoke_event_handler(self, name, args=(), kwargs=None):
+		if self.stopping:
+			return
 		if name not in self.event_handlers.keys():
 			logging.warning("Unhandeled '%s' event", name)
 			return
 		kwargs = kwargs or {}
+		instrument.begin("irc:" + name)
 		try:
 			self.event_handlers[name](*args, **kwargs)
 		except Exception:
 			logging.exception("Exception in IRC event handler")
+		instrument.end()
 
 
 	def on_welcome(self, conn, event):
 		logging.info("IRC connection established")
+		instrument.milestone("IRC registered")
 		if self.ns_password is not None:
 			self.connection.privmsg("NickServ", "IDENTIFY " + self.ns_password)
 		self._invoke_event_handler("connected")
@@ -41,17 +120,80 @@ class IRCBot(irc.bot.SingleServerIRCBot):
 	def on_nicknameinuse(self, conn, event):
 		self._invoke_event_handler("nick_in_use")
 
+	def on_cap(self, conn, event):
+		sub, caps = event.arguments[0], event.arguments[-1].split()
+		if sub in ("LS", "NEW"):
+			for c in caps:
+				name, _, value = c.partition("=")
+				self.caps_offered[name] = value
+			if sub == "LS" and len(event.arguments) > 2 and event.arguments[1] == "*":
+				return # more to come
+			req = [c for c in wanted_caps if c in self.caps_offered and c not in self.caps]
+			if "batch" not in req and "batch" not in self.caps and "draft/multiline" in req:
+				req.remove("draft/multiline")
+			if req:
+				conn.cap("REQ", *req)
+			elif sub == "LS":
+				conn.cap("END")
+		elif sub == "ACK":
+			for c in caps:
+				if c.startswith("-"):
+					self.caps.pop(c[1:], None)
+				else:
+					self.caps[c] = self.caps_offered.get(c, "")
+			logging.info("IRCv3 capabilities enabled: %s", ", ".join(sorted(self.caps.keys())))
+			conn.cap("END")
+		elif sub == "NAK":
+			logging.warning("Server refused IRCv3 capabilities: %s", ", ".join(caps))
+			conn.cap("END")
+		elif sub == "DEL":
+			for c in caps:
+				self.caps.pop(c, None)
+				self.caps_offered.pop(c, None)
+
+	def on_batch(self, conn, event):
+		ref = event.target[1:]
+		if event.target.startswith("+"):
+			if len(event.arguments) > 0 and event.arguments[0] == "draft/multiline":
+				self.batches[ref] = []
+			return
+		events = self.batches.pop(ref, None)
+		if not events:
+			return
+		# join the lines of a multiline message back together
+		text = events[0].arguments[0]
+		for e in events[1:]:
+			text += ("" if "draft/multiline-concat" in _tags(e) else "\n") + e.arguments[0]
+		first = events[0]
+		tags = [t for t in first.tags if t["key"] != "batch"]
+		merged = irc.client.Event(first.type, first.source, first.target, [text], tags)
+		self._on_message(conn, merged, "action" if first.type == "action" else "message")
+
+	def _on_message(self, conn, event, name):
+		tags = _tags(event)
+		if tags.get("batch") in self.batches:
+			self.batches[tags["batch"]].append(event)
+			return
+		if "echo-message" in self.caps and event.source.nick == conn.get_nickname():
+			if self.unconfirmed:
+				self.echo_rtt = time.monotonic() - self.unconfirmed.popleft()
+			return
+		ev = IRCEvent(event, tags=tags)
+		if "time" in tags:
+			self.lag = time.time() - ev.time
+		self._invoke_event_handler(name, (ev, ))
+
 	def on_privmsg(self, conn, event):
-		self._invoke_event_handler("message", (IRCEvent(event), ))
+		self._on_message(conn, event, "message")
 
 	def on_pubmsg(self, conn, event):
-		self._invoke_event_handler("message", (IRCEvent(event), ))
+		self._on_message(conn, event, "message")
 
 	def on_action(self, conn, event):
-		self._invoke_event_handler("action", (IRCEvent(event), ))
+		self._on_message(conn, event, "action")
 
 	def on_join(self, conn, event):
-		if event.source.split("!")[0] == conn.get_nickname():
+		if event.source.nick == conn.get_nickname():
 			return
 		self._invoke_event_handler("join", (IRCEvent(event), ))
 
@@ -64,8 +206,78 @@ class IRCBot(irc.bot.SingleServerIRCBot):
 			return
 		self._invoke_event_handler("kick", (IRCEvent(event, argname="othernick"), ))
 
+	def _track_members(self, conn, event):
+		t = event.type
+		if t == "namreply":
+			prefix = conn.features.prefix
+			for nick in event.arguments[2].split():
+				self._add_member(event.arguments[1], nick[1:] if nick[0] in prefix else nick)
+		elif t == "join":
+			if event.source.nick == conn.get_nickname():
+				self.members[irc_lower(event.target)] = set()
+			self._add_member(event.target, event.source.nick)
+		elif t in ("part", "kick"):
+			nick = event.arguments[0] if t == "kick" else event.source.nick
+			if nick == conn.get_nickname():
+				self.members.pop(irc_lower(event.target), None)
+				self._forget_nicks()
+			else:
+				self.members.get(irc_lower(event.target), set()).discard(irc_lower(nick))
+				self._forget_nicks(irc_lower(nick))
+		elif t == "quit":
+			key = irc_lower(event.source.nick)
+			for m in self.members.values():
+				m.discard(key)
+			self.real_nicks.pop(key, None)
+		elif t == "nick":
+			old, new = irc_lower(event.source.nick), irc_lower(event.target)
+			for m in self.members.values():
+				if old in m:
+					m.discard(old)
+					m.add(new)
+			self.real_nicks.pop(old, None)
+			if new != event.target:
+				self.real_nicks[new] = event.target
+
+	def _add_member(self, channel, nick):
+		m = self.members.get(irc_lower(channel))
+		if m is None:
+			return
+		key = irc_lower(nick)
+		m.add(key)
+		if key != nick:
+			self.real_nicks[key] = nick
+
+	def _forget_nicks(self, key=None):
+		keys = list(self.real_nicks.keys()) if key is None else [key]
+		for k in keys:
+			if not any(k in m for m in self.members.values()):
+				self.real_nicks.pop(k, None)
+
+	def find_nick(self, channel, nick):
+		# Returns how the server spells nick, if it is in channel
+		key = irc_lower(nick)
+		if key not in self.members.get(irc_lower(channel), ()):
+			return None
+		return self.real_nicks.get(key, key)
+
+	def _before_quit(self, conn, event):
+		nick = event.source.nick
+		for name, ch in self.channels.items():
+			if ch.has_user(nick):
+				# name is an IRCFoldedCase, which hashes like the lowercased name
+				self._invoke_event_handler("quit", (IRCEvent(event, channel=str(name)), ))
+
 	def on_disconnect(self, conn, event):
+		if self.stopping:
+			return
 		logging.warning("IRC connection error, reconnecting")
+		if self.unconfirmed:
+			logging.warning("%d message(s) were not confirmed by the server and may have been lost",
+				len(self.unconfirmed))
+		self.caps_offered, self.caps, self.batches = {}, {}, {}
+		self.members, self.real_nicks = {}, {}
+		self.unconfirmed.clear()
 		time.sleep(5)
 		self.jump_server()
 
@@ -80,34 +292,62 @@ class IRCClient():
 	def __init__(self, config):
 		# Read config
 		args = {}
-		args["ipv6"] = config.get("ipv6", True)
+		self.ipv6 = config.get("ipv6", True)
 		if config["ssl"]:
 			args["wrapper"] = _wrap_ssl
-		# Resolve host
-		family = 0 if args["ipv6"] else socket.AF_INET
-		try:
-			ai = socket.getaddrinfo(config["server"], 0, family=family, proto=socket.IPPROTO_TCP)
-		except socket.gaierror as e:
-			logging.error("Failed to resolve hostname: %r", e)
-			exit(1)
-		args["ipv6"] = args["ipv6"] and ai[0][0] == socket.AF_INET6 # this determines the socket type used
-		host = ai[0][4][0]
 		if "password" in config.keys():
-			serv = (host, config["port"], config["password"])
+			serv = (config["server"], config["port"], config["password"])
 		else:
-			serv = (host, config["port"])
-		# Actually create bot with correct params
-		kwargs = {"connect_factory": irc.connection.Factory(**args)}
+			serv = (config["server"], config["port"])
+		# the host is only resolved in connect()
+		self.factory = irc.connection.Factory(**args)
+		kwargs = {"connect_factory": self.factory}
 		args = [[serv], config["nick"], "pytgbridge (IRC)"]
 		ns_password = None if "nickpassword" not in config.keys() else config["nickpassword"]
-		self.bot = IRCBot(args, kwargs, ns_password=ns_password)
+		self.bot = IRCBot(args, kwargs, ns_password=ns_password, ircv3=config.get("ircv3", True))
+		self.batch_ids = itertools.count()
+	def connect(self):
+		# Resolves the host and connects, can run in another thread before
+		# run() starts processing the connection. Returns False if the host
+		# can't be resolved.
+		server = self.bot.servers.peek()
+		family = 0 if self.ipv6 else socket.AF_INET
+		try:
+			ai = socket.getaddrinfo(server.host, 0, family=family, proto=socket.IPPROTO_TCP)
+		except socket.gaierror as e:
+			logging.error("Failed to resolve hostname: %r", e)
+			return False
+		self.factory.family = ai[0][0] # this determines the socket type used
+		server.host = ai[0][4][0]
+		self.bot._connect()
+		return True
 	def run(self):
-		self.bot.start()
+		self.bot.reactor.process_forever()
 	def event_handler(self, name, func):
 		self.bot.event_handlers[name] = func
+	def find_nick(self, channel, nick):
+		return self.bot.find_nick(channel, nick)
+	def set_capture(self, capture):
+		self.bot.connection.add_global_handler("all_raw_messages",
+			lambda conn, event: capture.write("irc", event.arguments[0]), -50)
+	def stop(self):
+		# stop handling events, sending still works until quit()
+		self.bot.stopping = True
+	def quit(self, message):
+		if self.bot.unconfirmed:
+			logging.warning("%d message(s) not confirmed by the IRC server yet", len(self.bot.unconfirmed))
+		self.bot.connection.disconnect(message)
 
 	def join(self, channel):
-		self.bot.connection.join(channel)
+		try:
+			self.bot.connection.join(channel)
+		except irc.client.ServerNotConnectedError:
+			pass # will be joined once connected
+	def part(self, channel):
+		try:
+			self.bot.connection.part(channel)
+		except irc.client.ServerNotConnectedError:
+			pass
 	def privmsg(self, target, message):
 		if len(message) < MESSAGE_SPLIT_LEN:
 			msgs = [message]
@@ -116,7 +356,38 @@ class IRCClient():
 			for i in range(0, len(message), MESSAGE_SPLIT_LEN):
 				msgs.append(message[i:i + MESSAGE_SPLIT_LEN])
 		try:
+			if len(msgs) > 1 and self._fits_multiline(message, len(msgs)):
+				self._privmsg_batch(target, msgs)
+				return
 			for m in msgs:
 				self.bot.connection.privmsg(target, m)
+				self._sent()
 		except irc.client.ServerNotConnectedError:
 			logging.warning("Dropping message because IRC not connected yet")
+
+	def _fits_multiline(self, message, lines):
+		value = self.bot.caps.get("draft/multiline")
+		if value is None:
+			return False
+		limits = dict(kv.partition("=")[::2] for kv in value.split(",") if kv)
+		try:
+			if len(message.encode("utf-8")) > int(limits["max-bytes"]):
+				return False
+			return "max-lines" not in limits or lines <= int(limits["max-lines"])
+		except (KeyError, ValueError):
+			return False
+
+	def _privmsg_batch(self, target, msgs):
+		# send one logical message, split lines are marked to be concatenated
+		conn = self.bot.connection
+		ref = "ml%d" % next(self.batch_ids)
+		conn.send_raw("BATCH +%s draft/multiline %s" % (ref, target))
+		for i, m in enumerate(msgs):
+			tags = "batch=" + ref + (";draft/multiline-concat" if i > 0 else "")
+			conn.send_raw("@%s PRIVMSG %s :%s" % (tags, target, m))
+		conn.send_raw("BATCH -%s" % ref)
+		self._sent()
+
+	def _sent(self):
+		if "echo-message" in self.bot.caps:
+			self.bot.unconfirmed.append(time.monotonic())
@@ -0,0 +1,104 @@
+import re
+import time
+import logging
+import threading
+from collections import deque, OrderedDict
+
+SPLIT_MEMORY = 15 * 60 # how long nicks lost in a netsplit are remembered
+SUMMARY_MAX_NICKS = 5 # list nicks in a summary only up to this many
+
+split_re = re.compile(r"^[^ ]+\.[^ ]+ [^ ]+\.[^ ]+$")
+
+def is_netsplit(reason):
+	# servers use "<hub> <leaf>" as quit message for users lost in a split
+	return reason is not None and split_re.match(reason) is not None
+
+class LinkActivity():
+	def __init__(self):
+		self.recent = deque() # timestamps of recent events
+		self.pending = {"quit": [], "split": [], "rejoin": [], "join": [], "part": []}
+		self.timer = None
+		self.split_nicks = OrderedDict() # nick -> time lost in netsplit
+
+class MembershipCoalescer():
+	# Sends joins/parts/quits one by one as long as they are rare, but
+	# aggregates bursts (e.g. netsplits) per link into a single summary
+	def __init__(self, window, burst, send_single, send_summary):
+		self.window = window
+		self.burst = burst
+		self.send_single = send_single
+		self.send_summary = send_summary
+		self.state = {}
+		self.lock = threading.Lock()
+
+	def add(self, link, kind, nick, reason=None):
+		now = time.monotonic()
+		with self.lock:
+			st = self.state.get(link)
+			if st is None:
+				st = self.state[link] = LinkActivity()
+			while st.recent and st.recent[0] < now - self.window:
+				st.recent.popleft()
+			st.recent.append(now)
+			while st.split_nicks and next(iter(st.split_nicks.values())) < now - SPLIT_MEMORY:
+				st.split_nicks.popitem(last=False)
+			if kind == "quit" and is_netsplit(reason):
+				kind = "split"
+				st.split_nicks.pop(nick, None)
+				st.split_nicks[nick] = now
+			elif kind == "join" and st.split_nicks.pop(nick, None) is not None:
+				kind = "rejoin"
+			storm = kind in ("split", "rejoin") or len(st.recent) > self.burst
+			if st.timer is None and not storm:
+				single = True
+			else:
+				single = False
+				st.pending[kind].append(nick)
+				if st.timer is None:
+					st.timer = threading.Timer(self.window, self._flush, (link, ))
+					st.timer.daemon = True
+					st.timer.start()
+		if single:
+			self.send_single(link, kind, nick, reason)
+
+	def flush_all(self):
+		# Sends all summaries that are still waiting for their timer,
+		# returns False if any of them failed
+		with self.lock:
+			links = [link for link, st in self.state.items() if st.timer is not None]
+			for link in links:
+				self.state[link].timer.cancel()
+		ok = True
+		for link in links:
+			ok = self._flush(link) and ok
+		return ok
+
+	def _flush(self, link):
+		with self.lock:
+			st = self.state[link]
+			pending = st.pending
+			st.pending = {k: [] for k in pending.keys()}
+			st.timer = None
+		if not any(pending.values()):
+			return True # already sent by the timer
+		try:
+			self.send_summary(link, format_summary(pending))
+		except Exception:
+			logging.exception("Failed to send membership summary")
+			return False
+		return True
+
+def format_summary(pending):
+	def item(nicks, verb):
+		if len(nicks) <= SUMMARY_MAX_NICKS:
+			return "%s %s" % (", ".join(nicks), verb)
+		return "%d users %s" % (len(nicks), verb)
+	parts = []
+	for kind, verb in (("split", "quit"), ("rejoin", "rejoined"), ("quit", "quit"),
+			("join", "joined"), ("part", "left")):
+		if pending[kind]:
+			parts.append(item(pending[kind], verb))
+	s = " … ".join(parts)
+	if pending["split"] or pending["rejoin"]:
+		s = "Netsplit: " + s
+	return s
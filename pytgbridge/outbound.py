@@ -0,0 +1,131 @@
+import time
+import logging
+import threading
+from collections import deque, Counter
+
+from . import instrument
+
+# Priority classes, lower is more important
+PRIO_CHAT = 0
+PRIO_MEDIA = 1
+PRIO_EVENT = 2 # joins, parts, title changes, ...
+
+prio_names = {
+	PRIO_CHAT: "chat",
+	PRIO_MEDIA: "media",
+	PRIO_EVENT: "membership/metadata",
+}
+
+def format_shed(shed):
+	return "(%s dropped due to overload)" % ", ".join(
+		"%d %s" % (n, prio_names[p]) for p, n in sorted(shed.items()))
+
+class TargetQueue():
+	def __init__(self):
+		self.items = deque() # (prio, args, kwargs)
+		self.counts = Counter() # prio -> number of queued items
+		self.shed = Counter() # prio -> items dropped since last summary
+		self.overloaded = False
+
+class OutboundQueue():
+	# Decouples the bridge handlers from slow sends. Each target (chat/channel)
+	# has a bounded FIFO queue; once it is full the oldest item of the least
+	# important class is dropped and later replaced by a short summary.
+	# With several senders, targets are sent to in parallel, but each target
+	# only by one sender at a time so its messages stay in order.
+	def __init__(self, name, send, max_per_target, senders=1, format_shed=format_shed):
+		self.name = name
+		self.send = send
+		self.format_shed = format_shed # Counter of prio -> dropped items to text
+		self.max_per_target = max_per_target
+		self.queues = {}
+		self.ready = deque() # targets with queued items, in round-robin order
+		self.sending = set() # targets a sender is busy with
+		self.cond = threading.Condition()
+		self.shed_total = Counter() # prio name -> count
+		self.sent_total = 0
+		for i in range(senders):
+			t = threading.Thread(target=self._run, name="%s-sender-%d" % (name, i), daemon=True)
+			t.start()
+
+	def put(self, target, prio, *args, **kwargs):
+		with self.cond:
+			q = self.queues.get(target)
+			if q is None:
+				q = self.queues[target] = TargetQueue()
+			if len(q.items) >= self.max_per_target:
+				victim = max(p for p, n in q.counts.items() if n > 0)
+				if victim < prio:
+					# everything queued is more important than this
+					self._shed(target, q, prio)
+					return
+				for i, item in enumerate(q.items):
+					if item[0] == victim:
+						del q.items[i]
+						break
+				q.counts[victim] -= 1
+				self._shed(target, q, victim)
+			if len(q.items) == 0 and target not in self.sending and target not in self.ready:
+				self.ready.append(target)
+			q.items.append((prio, args, kwargs))
+			q.counts[prio] += 1
+			self.cond.notify()
+
+	def _shed(self, target, q, prio):
+		if not q.overloaded:
+			logging.warning("%s queue for %s is full, dropping %s messages", self.name, target, prio_names[prio])
+			q.overloaded = True
+		q.shed[prio] += 1
+		self.shed_total[prio_names[prio]] += 1
+
+	def pending(self):
+		with self.cond:
+			return sum(len(q.items) for q in self.queues.values())
+
+	def describe_shed(self):
+		with self.cond:
+			return ", ".join("%d %s" % (v, k) for k, v in sorted(self.shed_total.items())) or "none"
+
+	def drain(self, timeout):
+		# Wait until everything queued has been sent, returns False on timeout
+		deadline = time.monotonic() + timeout
+		with self.cond:
+			while self.sending or any(len(q.items) > 0 for q in self.queues.values()):
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return False
+				self.cond.wait(remaining)
+		return True
+
+	def _next(self):
+		with self.cond:
+			while not self.ready:
+				self.cond.wait()
+			target = self.ready.popleft()
+			q = self.queues[target]
+			prio, args, kwargs = q.items.popleft()
+			q.counts[prio] -= 1
+			shed = q.shed
+			q.shed = Counter()
+			if len(q.items) == 0:
+				q.overloaded = False
+			# queued again once this message has been sent, see _run()
+			self.sending.add(target)
+		return target, shed, args, kwargs
+
+	def _run(self):
+		while True:
+			target, shed, args, kwargs = self._next()
+			try:
+				if shed:
+					self.send(target, self.format_shed(shed))
+				self.send(target, *args, **kwargs)
+				instrument.milestone("first message sent", final=True)
+			except Exception:
+				logging.exception("Exception while sending %s message", self.name)
+			with self.cond:
+				self.sending.discard(target)
+				if len(self.queues[target].items) > 0:
+					self.ready.append(target)
+				self.sent_total += 1
+				self.cond.notify_all()
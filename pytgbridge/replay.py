@@ -0,0 +1,164 @@
+import sys
+import time
+import getopt
+import logging
+import itertools
+import threading
+from collections import defaultdict
+
+import telebot
+
+from .telegram import TelegramClient
+from .irc import IRCClient, IRCBot
+from .bridge import Bridge
+from .web_backend import WebBackend
+from .events import User
+from .capture import read_capture
+from .__main__ import parse_config
+from . import instrument
+
+DRAIN_TIMEOUT = 300
+
+# Feeds a capture (see -w in __main__) through the real bridge with all
+# network access replaced by counters, e.g. to compare performance
+# between versions or configurations.
+
+class Output():
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.messages = 0
+		self.bytes = 0
+	def add(self, data):
+		with self.lock:
+			self.messages += 1
+			self.bytes += len(data)
+
+class ReplayTelegramClient(TelegramClient):
+	def __init__(self):
+		super().__init__({"token": "0:replay"})
+		self.own_user = User(0, username="replay")
+		self.output = Output()
+	def stop(self, timeout):
+		return True
+	def send_message(self, chat_id, text, **kwargs):
+		self.output.add(text.encode("utf-8"))
+	def send_reply_message(self, event, text, **kwargs):
+		self.output.add(text.encode("utf-8"))
+	def get_file_url(self, file_id, allowed_failure=False):
+		return "https://api.telegram.org/file/bot%s/%s" % (self.token, file_id)
+
+class SinkSocket():
+	def __init__(self):
+		self.output = Output()
+	def send(self, data):
+		if data.startswith(b"PRIVMSG "):
+			self.output.add(data)
+		return len(data)
+
+class ReplayIRCClient(IRCClient):
+	def __init__(self, nick):
+		self.bot = IRCBot([[("127.0.0.1", 6667)], nick, "pytgbridge (IRC)"], ircv3=False)
+		self.batch_ids = itertools.count()
+		sink = SinkSocket()
+		self.bot.connection.connect("replay", 6667, nick, connect_factory=lambda addr: sink)
+		self.output = sink.output
+
+def percentile(values, p):
+	return values[min(int(len(values) * p), len(values) - 1)]
+
+class Replayer():
+	def __init__(self, config):
+		self.tg = ReplayTelegramClient()
+		self.irc = ReplayIRCClient(config["irc"]["nick"])
+		self.b = Bridge(self.tg, self.irc, WebBackend({"type": "stub"}), config["bridge"])
+		self.latencies = defaultdict(list) # event name -> seconds
+		self.lock = threading.Lock()
+		self.errors = 0
+		instrument.observer = self._observe
+
+	def _observe(self, t):
+		with self.lock:
+			self.latencies[t.name].append(t.elapsed())
+
+	def feed(self, source, payload):
+		try:
+			if source == "tg":
+				self.tg.bot.process_new_updates([telebot.types.Update.de_json(payload)])
+			elif source == "irc":
+				self.irc.bot.connection._process_line(payload)
+		except Exception:
+			logging.exception("Failed to replay %s record", source)
+			self.errors += 1
+
+	def run(self, path, speed=None):
+		# speed: factor relative to the original timing, None = as fast as possible
+		start = time.monotonic()
+		first = None
+		n = 0
+		for t, source, payload in read_capture(path):
+			if first is None:
+				first = t
+			if speed is not None:
+				delay = start + (t - first) / speed - time.monotonic()
+				if delay > 0:
+					time.sleep(delay)
+			self.feed(source, payload)
+			n += 1
+		fed = time.monotonic() - start
+		self.b.dispatch.join()
+		for q in self.b.out:
+			if not q.drain(DRAIN_TIMEOUT):
+				logging.warning("%d message(s) to %s still pending", q.pending(), q.name)
+		return n, fed, time.monotonic() - start
+
+	def report(self, n, fed, total):
+		print("Replayed %d records in %.2fs (all output sent after %.2fs), %d failed" % (n, fed, total, self.errors))
+		print("")
+		print("%-24s %8s %9s %9s %9s %9s" % ("event", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+		for name, values in sorted(self.latencies.items()):
+			values.sort()
+			print("%-24s %8d %9.2f %9.2f %9.2f %9.2f" % (name, len(values),
+				percentile(values, 0.5) * 1000, percentile(values, 0.9) * 1000,
+				percentile(values, 0.99) * 1000, values[-1] * 1000))
+		print("")
+		print("Dispatch queues (depth/highest per worker): %s" % self.b.dispatch.describe())
+		for name, o, q in (("IRC", self.irc.output, self.b.out.irc), ("Telegram", self.tg.output, self.b.out.tg)):
+			print("%s output: %d message(s), %d bytes, dropped: %s" % (name, o.messages, o.bytes, q.describe_shed()))
+
+def usage():
+	print("Usage: %s -m pytgbridge.replay [-q] [-c file] [-s speed] capture" % sys.executable)
+	print("Options:")
+	print("  -q    Be quieter, raise log level to WARNING")
+	print("  -c    Set location of config file (default: ./config.json)")
+	print("  -s    Replay speed relative to the capture, e.g. 1 or 10, or \"max\" (default: 1)")
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hqc:s:", ["help"])
+	except getopt.GetoptError as e:
+		print(str(e))
+		exit(1)
+	opts = dict(opts)
+	if len(args) != 1 or "-h" in opts or "--help" in opts:
+		usage()
+		exit(0)
+	speed = opts.get("-s", "1")
+	if speed == "max":
+		speed = None
+	else:
+		try:
+			speed = float(speed)
+			assert speed > 0
+		except (ValueError, AssertionError):
+			print("Invalid speed: %s" % speed)
+			exit(1)
+
+	loglevel = logging.INFO if "-q" not in opts else logging.WARNING
+	logging.basicConfig(format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=loglevel)
+
+	config = parse_config(opts.get("-c", "./config.json"))
+	r = Replayer(config)
+	r.report(*r.run(args[0], speed))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,103 @@
+import logging
+import mimetypes
+import urllib.parse
+
+from .telegram import mime_mapping
+
+MIN_PART_SIZE = 5 * 1024 * 1024 # S3 minimum for all but the last part
+
+# file extension -> mime type
+ext_mapping = {}
+for k, v in mime_mapping.items():
+	ext_mapping.setdefault(v, k)
+ext_mapping["jpg"] = "image/jpeg" # image/jpg is what Telegram uses, but not a registered type
+
+def guess_content_type(key):
+	ext = key.rsplit(".", 1)[-1] if "." in key else ""
+	if ext in ext_mapping:
+		return ext_mapping[ext]
+	return mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+class S3Writer():
+	# Buffers at most one part in memory, files smaller than that are
+	# uploaded with a single PutObject instead
+	def __init__(self, storage, key):
+		self.s3 = storage
+		self.key = key
+		self.content_type = guess_content_type(key)
+		self.buf = bytearray()
+		self.upload_id = None
+		self.parts = []
+
+	def write(self, data):
+		self.buf += data
+		if len(self.buf) >= self.s3.part_size:
+			self._upload_part()
+
+	def _upload_part(self):
+		client = self.s3.client
+		if self.upload_id is None:
+			r = client.create_multipart_upload(Bucket=self.s3.bucket, Key=self.key,
+				ContentType=self.content_type)
+			self.upload_id = r["UploadId"]
+		n = len(self.parts) + 1
+		r = client.upload_part(Bucket=self.s3.bucket, Key=self.key, UploadId=self.upload_id,
+			PartNumber=n, Body=bytes(self.buf))
+		self.parts.append({"ETag": r["ETag"], "PartNumber": n})
+		self.buf = bytearray()
+
+	def commit(self):
+		client = self.s3.client
+		if self.upload_id is None:
+			client.put_object(Bucket=self.s3.bucket, Key=self.key, Body=bytes(self.buf),
+				ContentType=self.content_type)
+			return
+		if len(self.buf) > 0:
+			self._upload_part()
+		client.complete_multipart_upload(Bucket=self.s3.bucket, Key=self.key,
+			UploadId=self.upload_id, MultipartUpload={"Parts": self.parts})
+
+	def abort(self):
+		self.buf = bytearray()
+		if self.upload_id is None:
+			return
+		try:
+			self.s3.client.abort_multipart_upload(Bucket=self.s3.bucket, Key=self.key,
+				UploadId=self.upload_id)
+		except Exception:
+			logging.exception("Aborting multipart upload of %s failed", self.key)
+
+class S3Storage():
+	def __init__(self, config):
+		try:
+			import boto3
+			import botocore.config
+		except ImportError:
+			logging.error("boto3 needs to be installed to use the s3 web backend (try: pip install boto3)")
+			exit(1)
+		self.bucket = config["bucket"]
+		self.prefix = config.get("prefix", "")
+		self.baseurl = config.get("baseurl", None)
+		self.presign_expiry = config.get("presign_expiry", 7 * 24 * 3600)
+		self.part_size = max(config.get("part_size", 8 * 1024 * 1024), MIN_PART_SIZE)
+		# the client is thread-safe and keeps a pool of connections
+		bc = botocore.config.Config(max_pool_connections=config.get("max_connections", 10))
+		self.client = boto3.client("s3",
+			endpoint_url=config.get("endpoint", None),
+			region_name=config.get("region", None),
+			aws_access_key_id=config.get("access_key", None),
+			aws_secret_access_key=config.get("secret_key", None),
+			config=bc)
+
+	def key(self, filepath):
+		return self.prefix + filepath
+
+	def writer(self, filepath):
+		return S3Writer(self, self.key(filepath))
+
+	def url(self, filepath):
+		if self.baseurl is not None:
+			return self.baseurl + "/" + urllib.parse.quote(self.key(filepath))
+		return self.client.generate_presigned_url("get_object",
+			Params={"Bucket": self.bucket, "Key": self.key(filepath)},
+			ExpiresIn=self.presign_expiry)
@@ -0,0 +1,201 @@
+import os
+import re
+import sys
+import json
+import getopt
+import hashlib
+import logging
+import itertools
+import threading
+
+COUNTER_BATCH = 100
+MAX_DIRS = 1 << 20
+
+counter_name_re = re.compile(r"^file_(\d+)(\.|$)")
+
+def write_atomic(path, data):
+	tmppath = path + ".tmp"
+	with open(tmppath, "wb") as f:
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+	os.rename(tmppath, path)
+
+class StorageLayout():
+	# Spreads files over a tree of hashed directories, e.g. fanout [256, 256]
+	# results in paths like "3f/a0/file_1.jpg"
+	def __init__(self, fanout):
+		self.fanout = list(fanout)
+		n = 1
+		for level in self.fanout:
+			if level < 2:
+				raise ValueError("fan-out must be at least 2 per level")
+			n *= level
+		if n > MAX_DIRS:
+			raise ValueError("fan-out results in too many directories (%d)" % n)
+		self.widths = [len("%x" % (level - 1)) for level in self.fanout]
+
+	def _names(self, level):
+		w = self.widths[level]
+		return ["%0*x" % (w, i) for i in range(self.fanout[level])]
+
+	def dirname(self, filename):
+		if not self.fanout:
+			return ""
+		v = int.from_bytes(hashlib.sha1(filename.encode("utf-8")).digest()[:8], "big")
+		parts = []
+		for level, w in zip(self.fanout, self.widths):
+			v, r = divmod(v, level)
+			parts.append("%0*x" % (w, r))
+		return "/".join(parts)
+
+	def path(self, filename):
+		d = self.dirname(filename)
+		return (d + "/" + filename) if d else filename
+
+	def all_dirs(self):
+		if not self.fanout:
+			return
+		names = [self._names(i) for i in range(len(self.fanout))]
+		for t in itertools.product(*names):
+			yield "/".join(t)
+
+	def describe(self):
+		return json.dumps({"fanout": self.fanout})
+
+	def precreate(self, basedir):
+		# Creating the directories up front is done only once per layout
+		marker = basedir + "/.layout"
+		try:
+			with open(marker, "r") as f:
+				if f.read() == self.describe():
+					return
+		except FileNotFoundError:
+			pass
+		logging.info("Creating directory structure in %s", basedir)
+		for d in self.all_dirs():
+			os.makedirs(basedir + "/" + d, exist_ok=True)
+		write_atomic(marker, self.describe().encode("ascii"))
+
+class LegacyLayout(StorageLayout):
+	# The original layout of 26 subdirectories named a-z
+	def __init__(self):
+		super().__init__([])
+
+	@staticmethod
+	def _hash(s):
+		v = 0
+		for c in s:
+			v ^= ord(c) * 37
+			v = (v << 1) & 0xffff | (v >> 15) # ROR by 1 bit
+		return v
+
+	def dirname(self, filename):
+		return chr(97 + LegacyLayout._hash(filename) % 26) # a-z
+
+	def all_dirs(self):
+		for i in range(26):
+			yield chr(97 + i)
+
+	def describe(self):
+		return json.dumps({"fanout": "legacy"})
+
+def make_layout(config):
+	if not config.get("use_subdirs", False):
+		return StorageLayout([])
+	fanout = config.get("subdir_fanout", None)
+	if fanout is None:
+		return LegacyLayout()
+	return StorageLayout(fanout)
+
+def highest_counter(basedir):
+	# Highest number used by "counter" filenames anywhere below basedir
+	n = 0
+	for _, dirs, files in os.walk(basedir):
+		dirs[:] = [d for d in dirs if not d.startswith(".")]
+		for name in files:
+			m = counter_name_re.match(name)
+			if m is not None:
+				n = max(n, int(m.group(1)))
+	return n
+
+class FileCounter():
+	# Hands out increasing numbers that are never reused, even across restarts.
+	# Numbers are reserved in batches so the state file isn't written every time.
+	# Without a state file, numbering continues after the files in seed_dir.
+	def __init__(self, path=None, batch=COUNTER_BATCH, seed_dir=None):
+		self.path = path
+		self.batch = batch
+		self.lock = threading.Lock()
+		self.next = 1
+		if path is not None:
+			try:
+				with open(path, "r") as f:
+					self.next = int(f.read().strip())
+			except FileNotFoundError:
+				if seed_dir is not None:
+					self.next = highest_counter(seed_dir) + 1
+					logging.info("No counter file found, continuing after existing files at %d", self.next)
+		self.reserved = self.next
+
+	def take(self):
+		with self.lock:
+			if self.next >= self.reserved:
+				self.reserved = self.next + self.batch
+				if self.path is not None:
+					write_atomic(self.path, b"%d\n" % self.reserved)
+			n = self.next
+			self.next += 1
+			return n
+
+def migrate(basedir, layout, links=True):
+	moved = 0
+	for root, dirs, files in os.walk(basedir):
+		dirs[:] = [d for d in dirs if not d.startswith(".")]
+		for name in files:
+			if name.startswith("."):
+				continue
+			old = os.path.relpath(os.path.join(root, name), basedir)
+			new = layout.path(name)
+			if old == new or os.path.islink(os.path.join(basedir, old)):
+				continue
+			if os.path.exists(os.path.join(basedir, new)):
+				logging.warning("Not moving %s, %s already exists", old, new)
+				continue
+			os.rename(os.path.join(basedir, old), os.path.join(basedir, new))
+			if links:
+				# keep previously posted URLs working
+				target = os.path.relpath(os.path.join(basedir, new), os.path.dirname(os.path.join(basedir, old)))
+				os.symlink(target, os.path.join(basedir, old))
+			moved += 1
+	return moved
+
+def usage():
+	print("Usage: %s [-f fanout] [-n] <webpath>" % sys.argv[0])
+	print("Moves existing files into the given directory layout.")
+	print("Options:")
+	print("  -f    Fan-out per directory level (default: 256,256), \"legacy\" for 26 directories")
+	print("  -n    Don't leave symlinks at the old locations")
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hf:n", ["help"])
+	except getopt.GetoptError as e:
+		print(str(e))
+		exit(1)
+	opts = dict(opts)
+	if len(args) != 1 or "-h" in opts or "--help" in opts:
+		usage()
+		exit(0)
+	logging.basicConfig(format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+	fanout = opts.get("-f", "256,256")
+	if fanout == "legacy":
+		layout = LegacyLayout()
+	else:
+		layout = StorageLayout(int(e) for e in fanout.split(",") if e)
+	layout.precreate(args[0])
+	n = migrate(args[0], layout, links="-n" not in opts)
+	logging.info("Moved %d file(s)", n)
+
+if __name__ == "__main__":
+	main()
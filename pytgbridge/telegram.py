@@ -1,6 +1,10 @@
 import telebot
 import logging
 import time
+import threading
+
+from . import instrument
+from .events import User, Entity, Message, Location, Venue, Contact, Game, Poll, PollOption, PhotoSize
 
 mapped_content_type = {
 	"text": "text",
@@ -51,15 +55,28 @@ mime_mapping = { # mime type -> file extension
 	"image/webp": "webp",
 }
 
+def convert_photo_size(p):
+	return PhotoSize(p.file_id, getattr(p, "file_unique_id", p.file_id), p.width, p.height)
+
+def _thumbnail(c):
+	# renamed from thumb to thumbnail in Bot API 6.6
+	t = getattr(c, "thumbnail", None) or getattr(c, "thumb", None)
+	return () if t is None else (convert_photo_size(t), )
+
 class TelegramMediaContainer():
+	__slots__ = ("type", "mime", "duration", "desc", "filename", "dimensions", "emoji",
+		"is_animated", "file_id", "file_size", "extension", "previews")
 	def __init__(self, orig, init_from="event"):
+		self.previews = () # smaller JPEG variants, largest first
 		if init_from == "photo_list":
 			self.type = "photo"
-			c = sorted(orig, key=lambda e: e.width*e.height, reverse=True)[0]
+			sizes = sorted(orig, key=lambda e: e.width*e.height, reverse=True)
+			c = sizes[0]
 			self.dimensions = (c.width, c.height)
 			self.file_id = c.file_id
 			self.file_size = c.file_size
 			self.extension = mime_mapping["image/jpg"]
+			self.previews = tuple(convert_photo_size(p) for p in sizes[1:])
 			return
 		elif init_from == "event":
 			pass # see below
@@ -83,13 +100,17 @@ class TelegramMediaContainer():
 			c = orig.animation
 			self.mime = c.mime_type
 			self.filename = c.file_name
+			self.previews = _thumbnail(c)
 		elif self.type == "document":
 			c = orig.document
 			self.mime = c.mime_type
 			self.filename = c.file_name
+			self.previews = _thumbnail(c)
 		elif self.type == "photo":
-			c = sorted(orig.photo, key=lambda e: e.width*e.height, reverse=True)[0]
+			sizes = sorted(orig.photo, key=lambda e: e.width*e.height, reverse=True)
+			c = sizes[0]
 			self.dimensions = (c.width, c.height)
+			self.previews = tuple(convert_photo_size(p) for p in sizes[1:])
 			mime = "image/jpg"
 		elif self.type == "sticker":
 			c = orig.sticker
@@ -101,11 +122,13 @@ class TelegramMediaContainer():
 			c = orig.video
 			self.duration = c.duration
 			self.dimensions = (c.width, c.height)
+			self.previews = _thumbnail(c)
 			mime = c.mime_type
 		elif self.type == "video_note":
 			c = orig.video_note
 			self.duration = c.duration
 			self.dimensions = c.length
+			self.previews = _thumbnail(c)
 			mime = "video/mp4" # no specified mime because ????
 		elif self.type == "voice":
 			c = orig.voice
@@ -120,6 +143,61 @@ class TelegramMediaContainer():
 		if self.extension == "bin":
 			logging.warning("MIME type '%s' wasn't found in mapping", mime)
 
+def convert_user(u):
+	if u is None:
+		return None
+	return User(u.id, u.username, u.first_name, u.last_name)
+
+def convert_entities(entities):
+	if entities is None:
+		return None
+	return [Entity(e.type, e.offset, e.length, e.url, convert_user(e.user)) for e in entities]
+
+def convert_payload(m):
+	t = m.content_type
+	if t == "location":
+		return Location(m.location.latitude, m.location.longitude)
+	elif t == "venue":
+		return Venue(m.venue.title, m.venue.address, m.venue.foursquare_id)
+	elif t == "contact":
+		return Contact(m.contact.first_name, m.contact.last_name, m.contact.phone_number)
+	elif t == "game":
+		return Game(m.game.title, m.game.description)
+	elif t == "poll":
+		p = m.poll
+		return Poll(p.id, p.question, tuple(PollOption(o.text, o.voter_count) for o in p.options),
+			p.total_voter_count, p.is_closed, p.is_anonymous, p.type, p.allows_multiple_answers)
+	elif t == "new_chat_members":
+		return tuple(convert_user(u) for u in m.new_chat_members)
+	elif t == "left_chat_member":
+		return convert_user(m.left_chat_member)
+	elif t == "new_chat_title":
+		return m.new_chat_title
+	elif t == "pinned_message":
+		return convert_message(m.pinned_message)
+	return None
+
+def convert_message(m, shallow=False):
+	# Turn a telebot Message into our compact representation
+	ev = Message(m.content_type, m.chat.id, m.chat.type, m.message_id, convert_user(m.from_user))
+	if m.text is not None:
+		ev.text, ev.entities = m.text, convert_entities(m.entities)
+	elif m.caption is not None:
+		ev.text, ev.entities = m.caption, convert_entities(m.caption_entities)
+	if shallow:
+		return ev
+	if m.reply_to_message is not None:
+		ev.reply_to = convert_message(m.reply_to_message, shallow=True)
+	if m.forward_from is not None:
+		ev.forward_from = convert_user(m.forward_from)
+	elif m.forward_from_chat is not None:
+		ev.forward_from = m.forward_from_chat.title
+	elif m.forward_sender_name is not None:
+		ev.forward_from = m.forward_sender_name
+	ev.via_bot = convert_user(m.via_bot)
+	ev.payload = convert_payload(m)
+	return ev
+
 class TelegramClient():
 	def __init__(self, config):
 		if config["token"] == "":
@@ -129,6 +207,8 @@ class TelegramClient():
 		self.bot = telebot.TeleBot(self.token, threaded=False)
 		self.event_handlers = {}
 		self.own_user = None
+		self.stopping = False
+		self.poll_thread = None
 
 		self._telebot_event_handler(self.cmd_start, commands=["start"])
 		self._telebot_event_handler(self.cmd_help, commands=["help"])
@@ -140,10 +220,20 @@ class TelegramClient():
 			self._telebot_event_handler(self.on_media, content_types=[k])
 		self._telebot_event_handler(self.on_new_chat_photo, content_types=["new_chat_photo"])
 
+	def connect(self):
+		# can run in another thread while the rest is set up, see run()
+		try:
+			self.own_user = self.bot.get_me()
+		except Exception as e:
+			logging.warning("%s while contacting Telegram, retrying later", type(e).__name__)
+
 	def run(self):
-		self.own_user = self.bot.get_me()
+		self.poll_thread = threading.current_thread()
+		if self.own_user is None:
+			self.own_user = self.bot.get_me()
 		logging.info("Polling for Telegram events")
-		while True:
+		instrument.milestone("Telegram polling started")
+		while not self.stopping:
 			try:
 				self.bot.polling(none_stop=True)
 			except Exception as e:
@@ -151,26 +241,54 @@ class TelegramClient():
 				logging.warning("%s while polling Telegram, retrying", type(e).__name__)
 				time.sleep(1)
 
+	def stop(self, timeout):
+		# Stops polling after the current batch of updates, returns False
+		# if that didn't happen within timeout
+		self.stopping = True
+		self.bot.stop_polling()
+		# Telegram only forgets updates once a later getUpdates call has
+		# confirmed them. Do that now, this also ends a pending long poll.
+		try:
+			self.bot.get_updates(offset=self.bot.last_update_id + 1, limit=1, timeout=0, long_polling_timeout=0)
+		except Exception as e:
+			logging.warning("Failed to confirm Telegram updates: %s", e)
+		if self.poll_thread is None:
+			return True
+		self.poll_thread.join(timeout)
+		return not self.poll_thread.is_alive()
+
 	def event_handler(self, name, func):
 		self.event_handlers[name] = func
 
+	def set_capture(self, capture):
+		# same as TeleBot.get_updates, but records the raw updates first
+		def get_updates(offset=None, limit=None, timeout=20, allowed_updates=None, long_polling_timeout=20):
+			json_updates = telebot.apihelper.get_updates(self.token, offset, limit, timeout,
+				allowed_updates, long_polling_timeout)
+			for ju in json_updates:
+				capture.write("tg", ju)
+			return [telebot.types.Update.de_json(ju) for ju in json_updates]
+		self.bot.get_updates = get_updates
+
 
 	def _invoke_event_handler(self, name, args=(), kwargs=None):
 		if name not in self.event_handlers.keys():
 			logging.warning("Unhandeled '%s' event", name)
 			return
 		kwargs = kwargs or {}
+		instrument.begin("tg:" + name)
 		try:
 			self.event_handlers[name](*args, **kwargs)
 		except Exception as e:
 			logging.exception("Exception in Telegram event handler")
+		instrument.end()
 
 	def _telebot_event_handler(self, _func, **kwargs):
 		self.bot.message_handler(**kwargs)(_func)
 
 	def _telebot_event_handler_passthrough(self, evname, **kwargs):
 		def h(message):
-			self._invoke_event_handler(evname, (message, ))
+			self._invoke_event_handler(evname, (convert_message(message), ))
 		self._telebot_event_handler(h, **kwargs)
 
 	def _is_our_cmd(self, message):
@@ -186,29 +304,32 @@ class TelegramClient():
 	def cmd_start(self, message):
 		if not self._is_our_cmd(message):
 			return
-		self._invoke_event_handler("cmd_start", (message, ))
+		self._invoke_event_handler("cmd_start", (convert_message(message), ))
 
 	def cmd_help(self, message):
 		if not self._is_our_cmd(message):
 			return
-		self._invoke_event_handler("cmd_help", (message, ))
+		self._invoke_event_handler("cmd_help", (convert_message(message), ))
 
 	def cmd_me(self, message):
-		self._invoke_event_handler("cmd_me", (message, ))
+		self._invoke_event_handler("cmd_me", (convert_message(message), ))
 
 	def on_media(self, message):
-		self._invoke_event_handler("media", (message, TelegramMediaContainer(message)))
+		ev = convert_message(message)
+		ev.media = TelegramMediaContainer(message)
+		self._invoke_event_handler("media", (ev, ))
 
 	def on_new_chat_photo(self, message):
-		media = TelegramMediaContainer(message.new_chat_photo, init_from="photo_list")
-		self._invoke_event_handler("cphoto_changed", (message, media))
+		ev = convert_message(message)
+		ev.media = TelegramMediaContainer(message.new_chat_photo, init_from="photo_list")
+		self._invoke_event_handler("cphoto_changed", (ev, ))
 
 
 	def send_message(self, chat_id, text, **kwargs):
 		self.bot.send_message(chat_id, text, **kwargs)
 
 	def send_reply_message(self, event, text, **kwargs):
-		self.bot.send_message(event.chat.id, text, reply_to_message_id=event.message_id, **kwargs)
+		self.bot.send_message(event.chat_id, text, reply_to_message_id=event.message_id, **kwargs)
 
 	def get_file_url(self, file_id, allowed_failure=False):
 		try:
@@ -0,0 +1,144 @@
+import html
+import string
+
+# Every line the bridge outputs, as name -> (direction, default).
+# "tg" templates are sent to Telegram as HTML, "irc" templates to IRC.
+# Fields are written as {name}, see template_fields for what's available.
+default_templates = {
+	# IRC -> Telegram
+	"irc_message": ("tg", "&lt;{nick}&gt; {text}"),
+	"irc_action": ("tg", "* {nick} {text}"),
+	"irc_join": ("tg", "{nick} has joined"),
+	"irc_part": ("tg", "{nick} has left"),
+	"irc_quit": ("tg", "{nick} has quit"),
+	"irc_quit_reason": ("tg", "{nick} has quit ({reason})"),
+	"irc_kick": ("tg", "{othernick} was kicked by {nick}"),
+	"irc_summary": ("tg", "{summary}"),
+	"irc_dropped": ("tg", "({dropped} dropped due to overload)"),
+	"irc_dropped_item": ("tg", "{count} {kind}"),
+	# Telegram -> IRC
+	"tg_prefix": ("irc", "<{user}>"),
+	"tg_prefix_action": ("irc", "* {user}"),
+	"tg_prefix_reply": ("irc", " @{user},"),
+	"tg_prefix_reply_irc": ("irc", " {nick},"), # reply to a bridged IRC message
+	"tg_prefix_forward": ("irc", " Fwd from {name}:"),
+	"tg_message": ("irc", "{prefix} {text}"),
+	"tg_media_message": ("irc", "{prefix} (Media message)"),
+	"tg_paste": ("irc", "{prefix} {preview} ({lines} lines) {url}"),
+	"tg_media": ("irc", "{prefix} {desc}"),
+	"tg_via": ("irc", "via @{user}"),
+	"media_preview": ("irc", "{preview} (full: {url})"),
+	"media_audio": ("irc", "(Audio, {duration})"),
+	"media_audio_desc": ("irc", "(Audio, {duration}: {desc})"),
+	"media_animation": ("irc", "(GIF)"),
+	"media_document": ("irc", "(Document, {size}) \"{filename}\""),
+	"media_document_mime": ("irc", "(Document, {mime}, {size}) \"{filename}\""),
+	"media_photo": ("irc", "(Photo, {width}x{height})"),
+	"media_sticker": ("irc", "(Sticker)"),
+	"media_sticker_dims": ("irc", "(Sticker, {width}x{height})"),
+	"media_sticker_animated": ("irc", "(Animated Sticker)"),
+	"media_sticker_animated_dims": ("irc", "(Animated Sticker, {width}x{height})"),
+	"media_sticker_emoji": ("irc", "{desc} {emoji}"),
+	"media_video": ("irc", "(Video, {duration})"),
+	"media_video_note": ("irc", "(Video Note, {duration})"),
+	"media_voice": ("irc", "(Voice, {duration})"),
+	"tg_location": ("irc", "{prefix} (Location, lat: {lat}, lon: {lon})"),
+	"tg_venue": ("irc", "{prefix} (Venue, {title}: {address}{url})"),
+	"venue_url": ("irc", ", http://foursquare.com/v/{id}"),
+	"tg_contact": ("irc", "{prefix} (Contact, Name: {name}, Phone: {phone})"),
+	"tg_game": ("irc", "{prefix} (Game, {desc})"),
+	"game_desc": ("irc", "\"{title}\""),
+	"game_desc_long": ("irc", "\"{title}\": {description}"),
+	"tg_poll": ("irc", "{prefix} ({desc}) {detail}"),
+	"tg_poll_update": ("irc", "({kind} update, {votes} votes) {detail}"),
+	# poll descriptions are built up by wrapping the kind in these
+	"poll_regular": ("irc", "Poll"),
+	"poll_quiz": ("irc", "Quiz"),
+	"poll_anonymous": ("irc", "Anonymous {kind}"),
+	"poll_closed": ("irc", "{kind} closed"),
+	"poll_votes": ("irc", "{kind} with {votes} votes"),
+	"poll_multi": ("irc", "{kind}, multi-choice"),
+	"poll_question": ("irc", "\"{question}\""),
+	"poll_option": ("irc", " … {text}"),
+	"poll_option_votes": ("irc", " … {text} {bold}({votes}){bold}"),
+	"poll_option_change": ("irc", " … {text} {bold}({votes}, {change}){bold}"),
+	"tg_dropped": ("irc", "({dropped} dropped due to overload)"),
+	"tg_dropped_item": ("irc", "{count} {kind}"),
+	"tg_user_joined": ("irc", "{user} has joined"),
+	"tg_user_added": ("irc", "{user} was added by {by}"),
+	"tg_user_left": ("irc", "{user} has left"),
+	"tg_user_removed": ("irc", "{user} was removed by {by}"),
+	"tg_title_changed": ("irc", "{user} set a new chat title: {title}"),
+	"tg_photo_changed": ("irc", "{user} set a new chat photo ({width}x{height}): {url}"),
+	"tg_photo_deleted": ("irc", "{user} deleted the chat photo"),
+	"tg_pinned": ("irc", "{user} pinned message: {text}"),
+}
+
+# fields available in each template (as found in the defaults)
+template_fields = {name: frozenset(f for _, f, _, _ in string.Formatter().parse(t) if f is not None)
+	for name, (_, t) in default_templates.items()}
+
+# fields that already contain formatted text and are not escaped
+raw_fields = {
+	"tg": frozenset(("text", "reason", "summary", "dropped")),
+	"irc": frozenset(),
+}
+nick_fields = frozenset(("nick", "othernick"))
+
+class TemplateError(ValueError):
+	pass
+
+def _escape_tg(v):
+	return html.escape(str(v), quote=False)
+
+def _escape_tg_bold(v):
+	return "<b>" + html.escape(str(v), quote=False) + "</b>"
+
+def _escape_irc(v):
+	# there is no escaping on IRC, but line breaks would split the message
+	return str(v).replace("\r", "").replace("\n", " … ")
+
+def _raw(v):
+	return str(v)
+
+def compile_template(name, text, bold_nicks=False):
+	if name not in default_templates:
+		raise TemplateError("unknown template '%s'" % name)
+	direction = default_templates[name][0]
+	fmt = ""
+	fields = []
+	try:
+		parsed = list(string.Formatter().parse(text))
+	except ValueError as e:
+		raise TemplateError("template '%s': %s" % (name, e))
+	for literal, field, spec, conv in parsed:
+		fmt += literal.replace("%", "%%")
+		if field is None:
+			continue
+		if field not in template_fields[name]:
+			raise TemplateError("template '%s' has no field '%s'" % (name, field))
+		if spec or conv:
+			raise TemplateError("template '%s': format specs are not supported" % name)
+		if field in raw_fields[direction]:
+			esc = _raw
+		elif direction == "irc":
+			esc = _escape_irc
+		elif field in nick_fields and bold_nicks:
+			esc = _escape_tg_bold
+		else:
+			esc = _escape_tg
+		fmt += "%s"
+		fields.append((field, esc))
+	fields = tuple(fields)
+	def render(**kwargs):
+		return fmt % tuple(esc(kwargs[f]) for f, esc in fields)
+	return render
+
+def compile_templates(overrides=None, bold_nicks=False):
+	# Returns name -> render function, e.g. t["irc_join"](nick=...)
+	overrides = overrides or {}
+	for name in overrides.keys():
+		if name not in default_templates:
+			raise TemplateError("unknown template '%s'" % name)
+	return {name: compile_template(name, overrides.get(name, text), bold_nicks)
+		for name, (_, text) in default_templates.items()}
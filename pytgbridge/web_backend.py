@@ -1,19 +1,45 @@
 import os
-import urllib
+import urllib.parse
+import urllib.request
 import logging
 import time
+import io
 import uuid
-# for built-in HTTP server:
+import gzip
+import hashlib
+import collections
 import threading
 import tempfile
-import http.server
-import socketserver
+from .storage import make_layout, FileCounter
 # for WebpConverter:
 import subprocess
 
-def http_server_thread(host, port, wwwpath):
+CHUNK_SIZE = 256 * 1024
+PRECOMPRESS_MIN_SIZE = 1024
+LAZY_MAX_PENDING = 100000 # files that were linked but not requested yet
+LAZY_WAIT_TIMEOUT = 120
+ABORT_GRACE = 5 # how long aborted transfers get to clean up on shutdown
+
+# http.server and socketserver are only needed for the built-in server
+def make_request_handler(backend):
+	import http.server
+	class RequestHandler(http.server.SimpleHTTPRequestHandler):
+		def do_GET(self):
+			if backend.serve_precompressed(self):
+				return
+			if not backend.serve_pending(self):
+				super().do_GET()
+		def do_HEAD(self):
+			backend.serve_pending(self, head=True)
+			super().do_HEAD()
+	return RequestHandler
+
+def http_server_thread(host, port, wwwpath, backend):
+	import socketserver
+	class HTTPServer(socketserver.ThreadingTCPServer):
+		daemon_threads = True
 	os.chdir(wwwpath)
-	serv = socketserver.TCPServer((host, port), http.server.SimpleHTTPRequestHandler)
+	serv = HTTPServer((host, port), make_request_handler(backend))
 	logging.info("Built-in HTTP server listening on %s:%d, dir: %s", host, port, wwwpath)
 	serv.serve_forever()
 
@@ -22,38 +48,85 @@ def urlopen(url, headers=None):
 	r = urllib.request.Request(url, headers=headers)
 	return urllib.request.urlopen(r)
 
-def fdcopy(fp1, fp2):
-	while True:
-		data = fp1.read(1024 * 1024)
-		if not data:
-			return
-		fp2.write(data)
-
-def download_file(url, f):
-	r = urlopen(url)
-	fdcopy(r, f)
-	r.close()
+def content_length(r):
+	v = r.headers.get("Content-Length")
+	return int(v) if v is not None and v.isdigit() else None
 
 def millitime():
 	return int(time.time() * 1000)
 
+class DownloadError(Exception):
+	pass
+
+StoredFile = collections.namedtuple("StoredFile", ["path", "size", "sha256", "duration"])
+
+class LocalFileWriter():
+	# Writes into a temporary file next to the destination and only makes
+	# it visible under its public name once it is complete
+	def __init__(self, dest):
+		self.dest = dest
+		fd, self.tmppath = tempfile.mkstemp(dir=os.path.dirname(dest), prefix=".tmp")
+		self.f = os.fdopen(fd, "wb")
+
+	def write(self, data):
+		self.f.write(data)
+
+	def commit(self):
+		self.f.flush()
+		os.fsync(self.f.fileno())
+		self.f.close()
+		os.chmod(self.tmppath, 0o644)
+		# unlike rename this fails instead of replacing a file that was already linked
+		os.link(self.tmppath, self.dest)
+		os.remove(self.tmppath)
+
+	def abort(self):
+		self.f.close()
+		try:
+			os.remove(self.tmppath)
+		except OSError:
+			pass
+
+class LazyFile():
+	def __init__(self, file_id, resolver, kind):
+		self.file_id = file_id
+		self.resolver = resolver
+		self.kind = kind
+		self.claimed = False
+		self.done = threading.Event()
+
 class WebBackend():
 	def __init__(self, config):
 		self.type = config["type"]
+		self.lazy = False
+		self.s3 = None
+		self.executor = None
 		if self.type == "external":
 			self.webpath = config["webpath"]
 			self.baseurl = config["baseurl"]
-			self.subdirs = config["use_subdirs"]
 		elif self.type == "builtin":
 			bind = config.get("bind", "127.0.0.1")
 			port = config["port"]
 			baseurl = config.get("baseurl", "http://%s:%d" % (bind, port))
-			self.subdirs = config["use_subdirs"]
 			# Used by download_and_serve():
 			self.webpath = tempfile.mkdtemp()
 			self.baseurl = baseurl
-			t = threading.Thread(target=http_server_thread, args=(bind, port, self.webpath))
+			# Used by serve_lazy():
+			self.lazy = config.get("lazy", False)
+			self.pending = collections.OrderedDict()
+			self.pending_lock = threading.Lock()
+			t = threading.Thread(target=http_server_thread, args=(bind, port, self.webpath, self))
 			t.start()
+		elif self.type == "s3":
+			from .s3_backend import S3Storage
+			self.s3 = S3Storage(config)
+			# only used for staging files that need to be converted
+			self.webpath = tempfile.mkdtemp()
+			self.baseurl = None
+			workers = config.get("upload_workers", 0)
+			if workers > 0:
+				import concurrent.futures
+				self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
 		elif self.type == "stub":
 			logging.warning("Web backend not functional! (stub)")
 			return
@@ -61,42 +134,190 @@ class WebBackend():
 			logging.error("Unknown web backend type")
 			exit(1)
 
+		# maximum file size, either one value or per media type (with "default" as fallback)
+		max_size = config.get("max_size", None)
+		if max_size is None or isinstance(max_size, int):
+			self.max_sizes = {"default": max_size}
+		else:
+			self.max_sizes = dict(max_size)
+		self.precompress = config.get("precompress", False) and self.s3 is None
+		self.stats = collections.Counter()
+		self.stats_lock = threading.Lock()
+		self.active = 0 # files being stored right now
+		self.cancelled = threading.Event()
+		self.uploads = set() # background uploads (futures) not finished yet
+		self.uploads_lock = threading.Lock()
+
+		try:
+			self.layout = make_layout(config)
+		except ValueError as e:
+			logging.error("Invalid subdir_fanout: %s", e)
+			exit(1)
+		# the other types store into a fresh temporary directory, where
+		# directories are created as needed instead
+		if self.type == "external":
+			self.layout.precreate(self.webpath)
+
 		self.f_mode = config.get("filename_mode", "counter")
 		if self.f_mode == "counter":
-			self.f_number = 1
-		elif self.f_mode in ("timestamp", "uuid"):
+			counter_file = None
+			if self.type == "external":
+				counter_file = self.webpath + "/.counter"
+			counter_file = config.get("counter_file", counter_file)
+			if counter_file is None and self.type == "s3":
+				# numbering would restart and overwrite objects that were already linked
+				logging.error("The s3 web backend needs counter_file with filename_mode \"counter\"")
+				exit(1)
+			seed_dir = self.webpath if self.type == "external" else None
+			self.counter = FileCounter(counter_file, seed_dir=seed_dir)
+		elif self.f_mode == "timestamp":
+			self.last_timestamp = 0
+			self.timestamp_lock = threading.Lock()
+		elif self.f_mode == "uuid":
 			pass
 		else:
 			logging.error("Unknown filename mode")
 			exit(1)
 
-	@staticmethod
-	def _hash(s):
-		v = 0
-		for c in s:
-			v ^= ord(c) * 37
-			v = (v << 1) & 0xffff | (v >> 15) # ROR by 1 bit
-		return v
-
 	def _filepath(self, filename):
-		if not self.subdirs:
-			return filename
-		h = WebBackend._hash(filename)
-		h = chr(97 + h % 26) # A-Z
-		os.makedirs(self.webpath + "/" + h, exist_ok=True)
-		return h + "/" + filename
+		return self.layout.path(filename)
 
 	def _filename(self, extension=None):
 		suff = ("." + extension) if extension else ""
 		if self.f_mode == "counter":
-			self.f_number += 1
-			return "file_%d%s" % (self.f_number - 1, suff)
+			return "file_%d%s" % (self.counter.take(), suff)
 		elif self.f_mode == "timestamp":
-			return "%d%s" % (millitime(), suff)
+			# files may be stored from several threads at once, keep names unique
+			with self.timestamp_lock:
+				self.last_timestamp = max(millitime(), self.last_timestamp + 1)
+				return "%d%s" % (self.last_timestamp, suff)
 		elif self.f_mode == "uuid":
 			return "%s%s" % (uuid.uuid4(), suff)
 
-	def download_and_serve(self, url, filename=None, extension=None, hook=None):
+	def _check_size(self, kind, size):
+		limit = self.max_sizes.get(kind, self.max_sizes.get("default"))
+		if limit is not None and size is not None and size > limit:
+			raise DownloadError("file too large (%d > %d bytes)" % (size, limit))
+		return limit
+
+	def _store(self, src, filepath, kind=None, tee=None, local=False):
+		limit = self._check_size(kind, None)
+		if self.s3 is not None and not local:
+			w = self.s3.writer(filepath)
+		else:
+			if self.type != "external":
+				os.makedirs(os.path.dirname(self.webpath + "/" + filepath), exist_ok=True)
+			w = LocalFileWriter(self.webpath + "/" + filepath)
+		start = time.monotonic()
+		h = hashlib.sha256()
+		size = 0
+		with self.stats_lock:
+			self.active += 1
+		try:
+			while True:
+				if self.cancelled.is_set():
+					raise DownloadError("aborted because of shutdown")
+				data = src.read(CHUNK_SIZE)
+				if not data:
+					break
+				size += len(data)
+				if limit is not None and size > limit:
+					raise DownloadError("file too large (more than %d bytes)" % limit)
+				h.update(data)
+				w.write(data)
+				if tee is not None:
+					tee(data)
+			w.commit()
+		except BaseException:
+			w.abort()
+			raise
+		finally:
+			with self.stats_lock:
+				self.active -= 1
+		ret = StoredFile(filepath, size, h.hexdigest(), time.monotonic() - start)
+		with self.stats_lock:
+			self.stats["files"] += 1
+			self.stats["bytes"] += ret.size
+			self.stats["seconds"] += ret.duration
+			if kind is not None:
+				self.stats[kind + "_files"] += 1
+				self.stats[kind + "_bytes"] += ret.size
+		logging.info("Stored %s: %d bytes in %.2fs, sha256 %s", ret.path, ret.size, ret.duration, ret.sha256)
+		return ret
+
+	def log_stats(self):
+		if self.type == "stub":
+			return
+		with self.stats_lock:
+			stats = self.stats.copy()
+			active = self.active
+		with self.uploads_lock:
+			uploads = len(self.uploads)
+		kinds = sorted(k[:-len("_files")] for k in stats if k.endswith("_files"))
+		logging.info("Web backend: %d file(s), %d bytes stored in %.1fs, %d active, %d upload(s) pending%s",
+			stats["files"], stats["bytes"], stats["seconds"], active, uploads,
+			"".join("; %s: %d file(s), %d bytes" % (k, stats[k + "_files"], stats[k + "_bytes"]) for k in kinds))
+
+	def shutdown(self, timeout):
+		# Lets running transfers finish, or aborts them once timeout has
+		# passed. Returns False if anything had to be aborted.
+		if self.type == "stub":
+			return True
+		deadline = time.monotonic() + timeout
+		uploads, queued = [], 0
+		if self.executor is not None:
+			import concurrent.futures
+			with self.uploads_lock:
+				uploads = list(self.uploads)
+			_, unfinished = concurrent.futures.wait(uploads, timeout)
+			# their links were already posted, so these are lost
+			queued = sum(1 for f in unfinished if f.cancel())
+			if queued > 0:
+				logging.warning("Cancelled %d queued upload(s)", queued)
+			self.executor.shutdown(wait=False)
+		while self.active > 0 and time.monotonic() < deadline:
+			time.sleep(0.1)
+		# uploads that are still connecting aren't counted in active yet
+		running = max(self.active, sum(1 for f in uploads if not f.done()))
+		if running == 0:
+			return queued == 0
+		logging.warning("Aborting %d unfinished download(s)", running)
+		self.cancelled.set()
+		deadline = time.monotonic() + ABORT_GRACE
+		while time.monotonic() < deadline and (self.active > 0 or not all(f.done() for f in uploads)):
+			time.sleep(0.1)
+		return False
+
+	def _upload_done(self, f):
+		with self.uploads_lock:
+			self.uploads.discard(f)
+
+	def _url(self, filepath):
+		if self.s3 is not None:
+			return self.s3.url(filepath)
+		return self.baseurl + "/" + filepath
+
+	def _download(self, url, filepath, kind=None, hook=None):
+		try:
+			r = urlopen(url)
+			try:
+				self._check_size(kind, content_length(r))
+				# files that need to be converted are staged locally
+				self._store(r, filepath, kind, local=hook is not None)
+			finally:
+				r.close()
+			if hook is not None:
+				filepath = hook(filepath, self.webpath)
+				if self.s3 is not None:
+					with open(self.webpath + "/" + filepath, "rb") as f:
+						self._store(f, filepath)
+					os.remove(self.webpath + "/" + filepath)
+		except Exception as e:
+			logging.warning("Download of %s failed: %s", filepath, e)
+			return None
+		return filepath
+
+	def download_and_serve(self, url, filename=None, extension=None, hook=None, kind=None):
 		if self.type == "stub":
 			return "<no link available>"
 		if filename is None:
@@ -105,21 +326,135 @@ class WebBackend():
 			assert extension is None
 
 		filepath = self._filepath(filename)
-		with open(self.webpath + "/" + filepath, "wb") as f:
-			download_file(url, f)
+		if self.executor is not None and hook is None:
+			# URL is known in advance, upload in the background
+			f = self.executor.submit(self._download, url, filepath, kind)
+			with self.uploads_lock:
+				self.uploads.add(f)
+			f.add_done_callback(self._upload_done)
+			return self._url(filepath)
+		filepath = self._download(url, filepath, kind, hook)
+		if filepath is None:
+			return None
+		return self._url(filepath)
+
+	def serve_text(self, text, extension="html"):
+		if self.type == "stub":
+			return "<no link available>"
+		filepath = self._filepath(self._filename(extension))
+		data = text.encode("utf-8")
+		try:
+			self._store(io.BytesIO(data), filepath)
+			if self.precompress and len(data) >= PRECOMPRESS_MIN_SIZE:
+				self._store(io.BytesIO(gzip.compress(data)), filepath + ".gz")
+		except Exception as e:
+			logging.warning("Storing %s failed: %s", filepath, e)
+			return None
+		return self._url(filepath)
 
-		if hook is not None:
-			filepath = hook(filepath, self.webpath)
+	def serve_precompressed(self, handler):
+		# Serve a .gz variant stored by serve_text() if the client accepts it
+		if not self.precompress or handler.command != "GET":
+			return False
+		if "gzip" not in handler.headers.get("Accept-Encoding", ""):
+			return False
+		path = handler.translate_path(handler.path)
+		try:
+			f = open(path + ".gz", "rb")
+		except OSError:
+			return False
+		with f:
+			fs = os.fstat(f.fileno())
+			handler.send_response(200)
+			handler.send_header("Content-Type", handler.guess_type(path))
+			handler.send_header("Content-Encoding", "gzip")
+			handler.send_header("Content-Length", str(fs.st_size))
+			handler.end_headers()
+			handler.copyfile(f, handler.wfile)
+		return True
+
+	# Lazy mode: hand out the URL now, fetch from Telegram on first request
+	def serve_lazy(self, file_id, resolver, extension=None, kind=None):
+		assert self.lazy
+		filepath = self._filepath(self._filename(extension))
+		with self.pending_lock:
+			self.pending[filepath] = LazyFile(file_id, resolver, kind)
+			while len(self.pending) > LAZY_MAX_PENDING:
+				self.pending.popitem(last=False)
 		return self.baseurl + "/" + filepath
 
+	def serve_pending(self, handler, head=False):
+		if not self.lazy:
+			return False
+		path = urllib.parse.unquote(urllib.parse.urlsplit(handler.path).path).lstrip("/")
+		with self.pending_lock:
+			entry = self.pending.get(path)
+			if entry is None:
+				return False
+			first = not entry.claimed
+			entry.claimed = True
+		if not first:
+			# someone else is already fetching it, serve from disk once done
+			entry.done.wait(LAZY_WAIT_TIMEOUT)
+			return False
+		if head:
+			self._fetch_pending(path, entry)
+			return False
+		self._fetch_pending(path, entry, handler)
+		return True
+
+	def _fetch_pending(self, path, entry, handler=None):
+		headers_sent = False
+		def tee(data):
+			nonlocal handler
+			if handler is None:
+				return
+			try:
+				handler.wfile.write(data)
+			except OSError: # client went away, finish the download anyway
+				handler = None
+		try:
+			url = entry.resolver(entry.file_id)
+			if url is None:
+				raise DownloadError("file could not be resolved")
+			r = urlopen(url)
+			try:
+				length = content_length(r)
+				self._check_size(entry.kind, length)
+				if handler is not None:
+					handler.send_response(200)
+					handler.send_header("Content-Type", handler.guess_type(path))
+					if length is not None:
+						handler.send_header("Content-Length", str(length))
+					handler.end_headers()
+					headers_sent = True
+				self._store(r, path, entry.kind, tee=tee)
+			finally:
+				r.close()
+			success = True
+		except Exception as e:
+			logging.warning("Lazy download of %s failed: %s", path, e)
+			if handler is not None and not headers_sent:
+				handler.send_error(502)
+			success = False
+		with self.pending_lock:
+			if success:
+				self.pending.pop(path, None)
+			else: # allow retrying later
+				self.pending[path] = LazyFile(entry.file_id, entry.resolver, entry.kind)
+		entry.done.set()
+
 class WebpConverter():
 	@staticmethod
-	def check():
+	def check(fatal=True):
 		try:
 			subprocess.check_call(["dwebp", "-version"], stdout=subprocess.DEVNULL)
 		except Exception:
 			logging.error("The WebP command line tools need to be installed to use this feature (try: apt install webp)")
-			os._exit(1)
+			if fatal:
+				os._exit(1)
+			return False
+		return True
 	@staticmethod
 	def hook(filepath, basedir):
 		if not filepath.endswith(".webp"):